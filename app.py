@@ -1,29 +1,36 @@
 ## import dependencies
+import asyncio
 import time
 import os
+from modules.preprocess_documents import load_chunk_store
+
+## setup PATH
+INPUT_DATA_PATH = "./data/raw"
+OUTPUT_DATA_PATH = "./data/vectors"
+
+## process documents first -> load_chunk_store forks its PDF workers while the process is still single-threaded
+## (modules.language_model starts the torch / OpenMP threads with its warm-up pass on import)
+preprocessed_docs = load_chunk_store(data_path=INPUT_DATA_PATH)
+
 from modules.language_model import llm, embedF
 from langchain_core.messages import AIMessage, HumanMessage
 from modules.conversation_history import ConversationSummaryMemory
-from modules.preprocess_documents import load_chunk_store
 from modules.decide_query_complexity import QueryComplexity
 from modules.chatbot_response import ChatbotResponse
 from modules.bm25_retriever import instantiate_bm25retriever
 from modules.semantic_retriever import SemanticRetriever
 from modules.multi_query_retriever import MultiQueryRetriever
 from modules.multi_hop_retriever import MultiHopRetriever
+from modules.semantic_cache import SemanticCache, is_context_free
+from modules.prompts import load_prompt
 
 ## supress langchain warning
 import warnings
 from langchain_core._api import LangChainBetaWarning
 warnings.filterwarnings("ignore", category=LangChainBetaWarning)
 
-## setup PATH
-INPUT_DATA_PATH = "./data/raw"
-OUTPUT_DATA_PATH = "./data/vectors"
-
 ## main RAG prompt template
-with open("./prompts/mainRAG-prompt.md") as f:
-    rag_prompt_template = f.read()
+rag_prompt_template = load_prompt("./prompts/mainRAG-prompt.md")
 
 ## conversation history
 chat_history = ConversationSummaryMemory(model=llm, k=3)
@@ -34,8 +41,11 @@ response_generator = ChatbotResponse(model=llm, rag_prompt_template=rag_prompt_t
 ## query complexity decider
 complexity_decider = QueryComplexity(model=llm)
 
-## process documents
-preprocessed_docs = load_chunk_store(data_path=INPUT_DATA_PATH)
+## semantic cache for repeated / near-duplicate user queries
+response_cache = SemanticCache(embedding_function=embedF, threshold=0.9, max_size=1000, ttl=300)
+
+## semantic cache for the multi-query fused documents -> paraphrased complex queries skip subquery generation + retrieval
+multiquery_docs_cache = SemanticCache(embedding_function=embedF, threshold=0.95, max_size=2048, ttl=3600)
 
 ## set up retrievers - bm25, semantic and multi-hop(hybrid)
 sparse_retriever = instantiate_bm25retriever(documents=preprocessed_docs)
@@ -46,6 +56,47 @@ dense_retriever = SemanticRetriever(
     vectordb_output_path=OUTPUT_DATA_PATH
 ).retriever
 
+## multi-hop retriever keeps its per-turn state in a HopState -> one shared instance (chain + caches) for every turn
+multihop_retriever = MultiHopRetriever(
+    model=llm,
+    bm25_retriever=sparse_retriever,
+    semantic_retriever=dense_retriever
+)
+
+## multi-query retriever keeps no per-turn state -> one shared instance (chain + docs cache) for every turn
+multiquery_retriever = MultiQueryRetriever(
+    model=llm,
+    bm25_retriever=sparse_retriever,
+    semantic_retriever=dense_retriever,
+    docs_cache=multiquery_docs_cache
+)
+
+## ---- PER-TURN CLASSIFICATION + RETRIEVAL ----
+async def main_turn(user_query: str):
+    retrieved_docs = []
+    subquery_plus_docs = ""
+
+    ## fetch complexity level while speculatively prefetching sparse + dense results for the raw query
+    complexity_tier, prefetched_sparse, prefetched_dense = await asyncio.gather(
+        complexity_decider.ainvoke(user_query=user_query, memory=chat_history),
+        sparse_retriever.ainvoke(user_query),
+        dense_retriever.ainvoke(user_query)
+    )
+
+    ## fetch document based on the retriever type decided from `complexity_tier`
+    ## both retrievers fire their sparse + dense searches concurrently
+    ## the prefetched results are fused with the multi-query rankings, on any other tier they are dropped
+    if complexity_tier == "complex":
+        retrieved_docs.extend(await multiquery_retriever.ainvoke(
+            user_query=user_query,
+            memory=chat_history,
+            prefetched_docs=prefetched_sparse + prefetched_dense
+        ))
+    elif complexity_tier == "multi_hop":
+        subquery_plus_docs += await multihop_retriever.ainvoke(user_query=user_query, memory=chat_history)
+
+    return complexity_tier, retrieved_docs, subquery_plus_docs
+
 ## ---- CONVERSATION STARTER ----
 welcome_message = "Welcome to the Legal Assistant Bot. How can I help you today? Write `exit` to quit."
 chat_history.append(AIMessage(content=welcome_message))
@@ -56,6 +107,10 @@ for letter in welcome_message:
     print(letter, flush=True, end="")
     time.sleep(0.03)
 
+## one event loop for the whole session -> the shared async http pool (modules/language_model.py) keeps its
+## keep-alive connections on the loop that opened them, a fresh asyncio.run per turn would hand it closed-loop sockets
+runner = asyncio.Runner()
+
 ### ------------- CONVERSATION LOOP ----------------
 while True:
     try:
@@ -75,39 +130,31 @@ while True:
                 time.sleep(0.03)
             break
 
-        ## fetch complexity level
-        complexity_tier = complexity_decider.invoke(
-            user_query=latest_user_query,
-            memory=chat_history
-        )
-
-        ## instantiate retrievers for every turn
-        multiquery_retriever = MultiQueryRetriever(
-            model=llm,
-            bm25_retriever=sparse_retriever,
-            semantic_retriever=dense_retriever
-        )
-
-        multihop_retriever = MultiHopRetriever(
-            model=llm,
-            bm25_retriever=sparse_retriever,
-            semantic_retriever=dense_retriever
-        )
-
-        ## fetch document based on the retriever type decided from `complexity_tier`
-        if complexity_tier == "complex":
-            retrieved_docs.extend(multiquery_retriever.invoke(user_query=latest_user_query, memory=chat_history))
-        elif complexity_tier == "multi-hop":
-            subquery_plus_docs += multihop_retriever.invoke(user_query=latest_user_query, memory=chat_history)
+        ## serve repeated / near-duplicate queries straight from the semantic cache
+        ## the cache is keyed on the query alone -> a follow-up that refers back into the chat ("what is the punishment for it?")
+        ## depends on the history, so it is neither served from nor stored in the cache
+        cacheable = is_context_free(latest_user_query)
+        query_vector = response_cache.embed(latest_user_query) if cacheable else None
+        cached_resp = response_cache.lookup(query_vector) if cacheable else None
+        if cached_resp is not None:
+            ## print AI response
+            print(f"\033[1m> AI:\033[0m (cached) {cached_resp}", flush=True, end="")
+
+            ## store the turn in the chat history
+            chat_history.append(HumanMessage(content=latest_user_query))
+            chat_history.append(AIMessage(content=cached_resp))
+
+            continue
+
+        ## fetch complexity level + documents for the retriever type it decides
+        complexity_tier, retrieved_docs, subquery_plus_docs = runner.run(main_turn(user_query=latest_user_query))
+
         ## forgot to handle "Irrelevant" complexity tier -> for now this is the way to go, will fix later
-        else:
+        if complexity_tier not in ("complex", "multi_hop"):
             ai_resp = "I'm here to assist you with Legal queries. Please refrain yourself from asking question outside this scope and chit-chatting."
 
             ## print AI response
-            print(f"\033[1m> AI:\033[0m ({complexity_tier}) ", end="")
-            for letter in ai_resp:
-                print(letter, flush=True, end="")
-                time.sleep(0.03)
+            print(f"\033[1m> AI:\033[0m ({complexity_tier}) {ai_resp}", flush=True, end="")
 
             ## append AI response to chat history
             chat_history.append(AIMessage(content=ai_resp))
@@ -118,22 +165,27 @@ while True:
         chat_history.append(HumanMessage(content=latest_user_query))  ## store it in the history
 
         # print(f">>> {complexity_tier}") ## for debugging
-        ## response generation
-        ai_resp = response_generator.invoke(
+        ## response generation, printed token by token as the llm streams it
+        print(f"\033[1m> AI:\033[0m ({complexity_tier}) ", end="")
+        ai_resp = ""
+        for chunk in response_generator.stream(
             memory=chat_history,
             subquery_docs=subquery_plus_docs,
             documents=retrieved_docs
-        )
-
-        ## print AI response
-        print(f"\033[1m> AI:\033[0m ({complexity_tier}) ", end="")
-        for letter in ai_resp:
-            print(letter, flush=True, end="")
-            time.sleep(0.03)
+        ):
+            print(chunk, flush=True, end="")
+            ai_resp += chunk
 
         ## append AI response to chat history
         chat_history.append(AIMessage(content=ai_resp))
 
+        ## cache the generated response for similar (context-free) queries
+        if cacheable:
+            response_cache.add(query_vector, ai_resp)
+
     except KeyboardInterrupt:
         print("\n\n[ALERT] ^C: Keyboard Interruption detected. Session Terminated!!")
-        break
\ No newline at end of file
+        break
+
+## close the session loop (and with it the pooled connections opened on it)
+runner.close()
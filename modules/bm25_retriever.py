@@ -1,22 +1,225 @@
 ## import langchain dependencies
-from langchain_community.retrievers import BM25Retriever
+import os
+import json
+import hashlib
+import numpy as np
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+from langchain.schema import Document
 from nltk.tokenize import word_tokenize
 from modules.preprocess_documents import load_chunk_store
 
+## setup PATH
+BM25_INDEX_PATH = "./data/bm25"
+
+## same default tokenizer as langchain's BM25Retriever
+def default_preprocessing_func(text: str) -> List[str]:
+    return text.split()
+
+class BM25Index:
+    """
+    BM25 (Okapi) index stored as flat numpy arrays:
+    -> postings of term id `t` live at doc_ids[offsets[t]:offsets[t+1]] along with their term_freqs
+    -> build once with BM25Index.build(tokenized_corpus) and persist with .save(path)
+    -> later starts .load(path) memory-maps the arrays instead of re-tokenizing the corpus
+    -> every posting's BM25 contribution (impact) is precomputed at build time, a query only sums impacts[start:end]
+    -> scores match rank_bm25.BM25Okapi (k1=1.5, b=0.75, epsilon=0.25)
+    """
+    ARRAYS = ("offsets", "doc_ids", "term_freqs", "doc_lens", "idf", "impacts")
+
+    def __init__(
+            self,
+            vocab: List[str],
+            offsets: np.ndarray,
+            doc_ids: np.ndarray,
+            term_freqs: np.ndarray,
+            doc_lens: np.ndarray,
+            idf: np.ndarray,
+            k1: float = 1.5,
+            b: float = 0.75,
+            corpus_key: str = "",
+            impacts: Optional[np.ndarray] = None
+    ) -> None:
+        self.vocab: Dict[str, int] = {token: term_id for term_id, token in enumerate(vocab)}
+        self.offsets = offsets
+        self.doc_ids = doc_ids
+        self.term_freqs = term_freqs
+        self.doc_lens = doc_lens
+        self.idf = idf
+        self.k1 = k1
+        self.b = b
+        self.corpus_key = corpus_key ## fingerprint of the chunks + tokenizer the index was built from
+
+        ## document length normalisation only depends on the corpus -> compute once
+        avgdl = float(doc_lens.mean()) if len(doc_lens) else 0.0
+        self._length_norm = (k1 * (1 - b + b * doc_lens / (avgdl or 1.0))).astype(np.float32)
+
+        ## idf * tf * (k1 + 1) / (tf + length_norm) per posting -> indexes saved before impacts existed get them here
+        self.impacts = impacts if impacts is not None else self.__compute_impacts()
+
+    def __compute_impacts(self) -> np.ndarray:
+        posting_terms = np.repeat(np.arange(len(self.idf)), np.diff(self.offsets))
+        tf = self.term_freqs
+        return (self.idf[posting_terms] * tf * (self.k1 + 1) / (tf + self._length_norm[self.doc_ids])).astype(np.float32)
+
+    @classmethod
+    def build(cls, tokenized_corpus: List[List[str]], k1: float = 1.5, b: float = 0.75, epsilon: float = 0.25) -> "BM25Index":
+        vocab: Dict[str, int] = {}
+        term_ids, doc_ids, term_freqs = [], [], []
+        doc_lens = np.zeros(len(tokenized_corpus), dtype=np.float32)
+
+        for doc_id, tokens in enumerate(tokenized_corpus):
+            doc_lens[doc_id] = len(tokens)
+            for token, freq in Counter(tokens).items():
+                term_ids.append(vocab.setdefault(token, len(vocab)))
+                doc_ids.append(doc_id)
+                term_freqs.append(freq)
+
+        ## group the postings by term id -> CSR style offsets
+        term_ids = np.asarray(term_ids, dtype=np.int64)
+        order = np.argsort(term_ids, kind="stable")
+        doc_freqs = np.bincount(term_ids, minlength=len(vocab))
+        offsets = np.concatenate(([0], np.cumsum(doc_freqs))).astype(np.int64)
+
+        ## okapi idf, negative values are floored to epsilon * average idf just like rank_bm25
+        n_docs = len(tokenized_corpus)
+        idf = np.log(n_docs - doc_freqs + 0.5) - np.log(doc_freqs + 0.5)
+        idf[idf < 0] = epsilon * idf.mean()
+
+        return cls(
+            vocab=list(vocab),
+            offsets=offsets,
+            doc_ids=np.asarray(doc_ids, dtype=np.int32)[order],
+            term_freqs=np.asarray(term_freqs, dtype=np.float32)[order],
+            doc_lens=doc_lens,
+            idf=idf.astype(np.float32),
+            k1=k1,
+            b=b
+        )
+
+    def save(self, path: str) -> None:
+        os.makedirs(path, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "vocab.json"), "w", encoding="utf-8") as f:
+            json.dump({"vocab": list(self.vocab), "k1": self.k1, "b": self.b, "corpus_key": self.corpus_key}, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str, mmap: bool = True) -> "BM25Index":
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r" if mmap else None)
+            for name in cls.ARRAYS if os.path.exists(os.path.join(path, f"{name}.npy"))
+        }
+        return cls(vocab=meta["vocab"], k1=meta["k1"], b=meta["b"], corpus_key=meta.get("corpus_key", ""), **arrays)
+
+    def __postings(self, query_tokens: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+        ## (doc ids, impacts) of every query token's postings back to back, a repeated token appears repeatedly
+        slices = [
+            slice(self.offsets[term_id], self.offsets[term_id + 1])
+            for term_id in (self.vocab.get(token) for token in query_tokens) if term_id is not None
+        ]
+        if not slices:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        return np.concatenate([self.doc_ids[s] for s in slices]), np.concatenate([self.impacts[s] for s in slices])
+
+    def get_scores(self, query_tokens: List[str]) -> np.ndarray:
+        ## one weighted bincount over the concatenated postings instead of a fancy-index update per term
+        docs, impacts = self.__postings(query_tokens)
+        return np.bincount(docs, weights=impacts, minlength=len(self.doc_lens)).astype(np.float32)
+
+    def get_batch_scores(self, batch_query_tokens: List[List[str]]) -> np.ndarray:
+        """
+        [Q, N] scores for Q queries in one pass:
+        -> every query's postings are shifted into its own row (doc id + row * N) and summed by a single bincount
+        -> row q equals get_scores(batch_query_tokens[q]), repeated query tokens count as many times as they occur
+        """
+        n_docs = len(self.doc_lens)
+        docs, impacts = [], []
+        for row, query_tokens in enumerate(batch_query_tokens):
+            row_docs, row_impacts = self.__postings(query_tokens)
+            docs.append(row_docs.astype(np.int64) + row * n_docs)
+            impacts.append(row_impacts)
+        if not docs:
+            return np.zeros((0, n_docs), dtype=np.float32)
+        flat = np.bincount(np.concatenate(docs), weights=np.concatenate(impacts), minlength=len(batch_query_tokens) * n_docs)
+        return flat.astype(np.float32).reshape(len(batch_query_tokens), n_docs)
+
+    @staticmethod
+    def __best(scores: np.ndarray, n: int) -> np.ndarray:
+        n = min(n, len(scores))
+        if n <= 0:
+            return np.empty(0, dtype=np.int64)
+        best = np.argpartition(-scores, n - 1)[:n]
+        return best[np.argsort(-scores[best], kind="stable")]
+
+    def top_n(self, query_tokens: List[str], n: int) -> np.ndarray:
+        return self.__best(self.get_scores(query_tokens), n)
+
+    def top_n_many(self, batch_query_tokens: List[List[str]], n: int) -> List[np.ndarray]:
+        return [self.__best(row, n) for row in self.get_batch_scores(batch_query_tokens)]
+
+class BM25IndexRetriever(BaseRetriever):
+    """
+    LangChain retriever over a (persisted) BM25Index:
+    -> drop-in replacement for langchain_community's BM25Retriever, invoke(query) -> List[Document]
+    -> retrieve_many(queries) -> List[List[Document]] scores a batch of queries at once
+    """
+    index: BM25Index
+    docs: List[Document]
+    k: int = 10
+    preprocess_func: Callable[[str], List[str]] = default_preprocessing_func
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        top_ids = self.index.top_n(self.preprocess_func(query), n=self.k)
+        return [self.docs[doc_id] for doc_id in top_ids]
+
+    def retrieve_many(self, queries: List[str]) -> List[List[Document]]:
+        ## all queries scored against the postings in a single batched pass -> one result list per query
+        top_ids = self.index.top_n_many([self.preprocess_func(query) for query in queries], n=self.k)
+        return [[self.docs[doc_id] for doc_id in ids] for ids in top_ids]
+
+## fingerprint of the chunk texts + tokenizer -> decides whether a persisted index is still valid
+def corpus_fingerprint(documents: List[Document], preprocess_func: Callable[[str], List[str]]) -> str:
+    digest = hashlib.sha256(getattr(preprocess_func, "__qualname__", repr(preprocess_func)).encode("utf-8"))
+    for doc in documents:
+        digest.update(doc.page_content.encode("utf-8"))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
 ## BM25 retriever
-def instantiate_bm25retriever(documents, tokenizer = None):
-    if not tokenizer:
-        return BM25Retriever.from_documents(documents=documents, k=10)
-    else:
-        return BM25Retriever.from_documents(documents=documents, preprocess_func=tokenizer, k=10)
+def instantiate_bm25retriever(documents, tokenizer = None, index_path: str = BM25_INDEX_PATH):
+    preprocess_func = tokenizer if tokenizer else default_preprocessing_func
+    corpus_key = corpus_fingerprint(documents, preprocess_func)
+
+    index = None
+    if os.path.exists(index_path):
+        index = BM25Index.load(index_path)
+        ## persisted index was built for different chunks (or another tokenizer) -> rebuild it
+        if index.corpus_key != corpus_key or len(index.doc_lens) != len(documents):
+            index = None
+
+    if index is None:
+        index = BM25Index.build([preprocess_func(doc.page_content) for doc in documents])
+        index.corpus_key = corpus_key
+        index.save(index_path)
+
+    return BM25IndexRetriever(index=index, docs=documents, k=10, preprocess_func=preprocess_func)
 
 # ---------------------------------------------------------------------------------------------------------
 if __name__=="__main__":
+    import shutil
+
+    DUMMY_INDEX_PATH = "./data/bm25-dummy"
+
     ## load and chunk
     preprocessed_docs = load_chunk_store(data_path="./data/raw")
 
     ## BM25 retriever
-    bm25_retriever = instantiate_bm25retriever(documents=preprocessed_docs, tokenizer=word_tokenize)
+    bm25_retriever = instantiate_bm25retriever(documents=preprocessed_docs, tokenizer=word_tokenize, index_path=DUMMY_INDEX_PATH)
 
     ## user query
     user_query = input("> Human: ")
@@ -29,4 +232,7 @@ if __name__=="__main__":
     for index, docs in enumerate(retrieved_docs, start=1):
         print(f"{index}:\n\n\n{docs.page_content}")
     print(f"Output:{type(retrieved_docs)}")
-    print(f"Output:{type(retrieved_docs[0])}")
\ No newline at end of file
+    print(f"Output:{type(retrieved_docs[0])}")
+
+    ## once done delete the dummy index
+    shutil.rmtree(DUMMY_INDEX_PATH)
@@ -0,0 +1,168 @@
+## import dependencies
+import os
+import hashlib
+import sqlite3
+import threading
+import numpy as np
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, List, Optional, Tuple
+from langchain_core.embeddings import Embeddings
+
+## setup PATH
+EMBEDDING_CACHE_PATH = "./data/emb-cache/embeddings.sqlite"
+
+## lowercase + collapse whitespace -> lossless for uncased tokenizers such as all-MiniLM-L6-v2's
+def collapse_query(text: str) -> str:
+    return " ".join(text.lower().split())
+
+class CachedEmbeddings(Embeddings):
+    """
+    Caching wrapper around a LangChain embedding model:
+    -> embed_query is memoized in an LRU cache of `maxsize` entries, keyed by `query_normalizer(text)` when one is given
+    -> embed_documents is memoized per text in an LRU of `maxsize` entries, keyed by SHA-256(backend:model_name + "\\0" + text),
+       only the misses are embedded (in one batch) -> building a store never keeps the whole corpus' vectors alive
+    -> with `cache_path`, query embeddings are also persisted in SQLite (float32 bytes) so they survive restarts
+    -> prime_queries(texts) embeds known-in-advance queries (e.g. an eval set) in batches, later embed_query calls are cache hits
+    -> any other attribute (model_name, model_kwargs, ...) is forwarded to the wrapped model
+    """
+    def __init__(
+            self,
+            embedding_function: Embeddings,
+            maxsize: int = 2048,
+            cache_path: Optional[str] = None,
+            query_normalizer: Optional[Callable[[str], str]] = None
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.query_normalizer = query_normalizer
+        self.model_name = getattr(embedding_function, "model_name", type(embedding_function).__name__)
+        ## backend is part of the key -> light/ONNX/torch encoders of the same model never share cached vectors
+        self._key_prefix = f"{type(embedding_function).__name__}:{self.model_name}"
+        self._document_cache: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._document_maxsize = maxsize
+        ## batch-embedded queries, kept (up to `maxsize`, oldest dropped first) so priming the same query again is free
+        self._primed: "OrderedDict[str, Tuple[float, ...]]" = OrderedDict()
+        self._primed_maxsize = maxsize
+        ## both in-memory LRUs are read + reordered from worker threads (asyncio.to_thread, executors) -> every access holds this lock,
+        ## model calls and SQLite I/O happen outside it
+        self._memory_lock = threading.Lock()
+        ## per-instance LRU, tuples since the cached value must not be mutated by callers
+        self._cached_query = lru_cache(maxsize=maxsize)(self.__embed_query)
+
+        self._disk: Optional[sqlite3.Connection] = None
+        self._disk_lock = threading.Lock() ## queries are embedded from worker threads (asyncio.to_thread)
+        if cache_path:
+            os.makedirs(os.path.dirname(cache_path) or ".", exist_ok=True)
+            self._disk = sqlite3.connect(cache_path, check_same_thread=False)
+            self._disk.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+            self._disk.commit()
+
+    def __embed_query(self, text: str) -> Tuple[float, ...]:
+        with self._memory_lock:
+            primed = self._primed.get(text)
+        if primed is not None:
+            return primed ## copied into the LRU (and is already on disk)
+        if self._disk is None:
+            return tuple(self.embedding_function.embed_query(text))
+
+        key = self.__cache_key(text)
+        with self._disk_lock:
+            row = self._disk.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return tuple(np.frombuffer(row[0], dtype=np.float32).tolist())
+
+        vector = self.embedding_function.embed_query(text)
+        with self._disk_lock:
+            self._disk.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                (key, np.asarray(vector, dtype=np.float32).tobytes())
+            )
+            self._disk.commit()
+        return tuple(vector)
+
+    def __cache_key(self, text: str) -> bytes:
+        return hashlib.sha256(f"{self._key_prefix}\0{text}".encode("utf-8")).digest()
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.query_normalizer is not None:
+            text = self.query_normalizer(text)
+        return list(self._cached_query(text))
+
+    def prime_queries(self, texts: List[str], batch_size: int = 64) -> None:
+        ## batch-embed queries ahead of time -> one model call per `batch_size` queries instead of one per query
+        ## wrapped models without an `embed_queries` batch method are assumed symmetric (same vector for query / document)
+        batch_embed = getattr(self.embedding_function, "embed_queries", self.embedding_function.embed_documents)
+        if self.query_normalizer is not None:
+            texts = [self.query_normalizer(text) for text in texts]
+        with self._memory_lock:
+            for text in texts:
+                if text in self._primed:
+                    self._primed.move_to_end(text)
+            pending = list(dict.fromkeys(text for text in texts if text not in self._primed))
+
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            if self._disk is not None:
+                with self._disk_lock:
+                    stored = {
+                        key for (key,) in self._disk.execute(
+                            f"SELECT key FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                            [self.__cache_key(text) for text in batch]
+                        )
+                    }
+                batch = [text for text in batch if self.__cache_key(text) not in stored] ## already persisted -> nothing to do
+            if not batch:
+                continue
+
+            vectors = batch_embed(batch)
+            with self._memory_lock:
+                self._primed.update((text, tuple(vector)) for text, vector in zip(batch, vectors))
+                while len(self._primed) > self._primed_maxsize:
+                    self._primed.popitem(last=False)
+            if self._disk is not None:
+                with self._disk_lock:
+                    self._disk.executemany(
+                        "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                        [(self.__cache_key(text), np.asarray(vector, dtype=np.float32).tobytes()) for text, vector in zip(batch, vectors)]
+                    )
+                    self._disk.commit()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys = [self.__cache_key(text) for text in texts]
+
+        ## embed every unseen text once, in a single batched call
+        with self._memory_lock:
+            found = {key: self._document_cache[key] for key in keys if key in self._document_cache}
+            for key in found:
+                self._document_cache.move_to_end(key)
+        misses = {key: text for key, text in zip(keys, texts) if key not in found}
+        if misses:
+            vectors = self.embedding_function.embed_documents(list(misses.values()))
+            found.update(zip(misses.keys(), vectors))
+            with self._memory_lock:
+                self._document_cache.update(zip(misses.keys(), vectors))
+                while len(self._document_cache) > self._document_maxsize:
+                    self._document_cache.popitem(last=False) ## evict the least recently used text
+
+        return [list(found[key]) for key in keys]
+
+    def __getattr__(self, name: str):
+        ## only reached for attributes not defined on the wrapper
+        if name == "embedding_function":
+            raise AttributeError(name)
+        return getattr(self.embedding_function, name)
+
+## ---- TEST ----
+if __name__=="__main__":
+    import time
+    from modules.embeddings import get_embedder
+
+    embedF = CachedEmbeddings(get_embedder())
+    user_query = "What are the conditions for solemnizing a special marriage?"
+
+    for attempt in ("cold", "warm"):
+        start = time.perf_counter()
+        embedF.embed_query(user_query)
+        print(f"> {attempt} embed_query: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    print(f"> {embedF._cached_query.cache_info()}")
@@ -2,19 +2,26 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 from langchain.schema import Document
 from modules.conversation_history import ConversationSummaryMemory
-from typing import List
+from typing import Dict, Iterator, List
 
 class ChatbotResponse:
     def __init__(self, model, rag_prompt_template) -> None:
         self.model = model
         self.rag_prompt_template = rag_prompt_template
+        ## the prompt template never changes -> parse it and wire the chain once
+        self.chain = self.__create_chain()
 
-    def invoke(
-            self,
+    def __create_chain(self):
+        prompt = ChatPromptTemplate.from_template(self.rag_prompt_template)
+        chain = prompt | self.model | StrOutputParser()
+        return chain
+
+    @staticmethod
+    def __prepare_inputs(
             memory: ConversationSummaryMemory,
-            documents: List[Document] = [],
-            subquery_docs: str = ""
-    ):
+            documents: List[Document],
+            subquery_docs: str
+    ) -> Dict:
         ## context placeholder
         context = "\n"
 
@@ -23,13 +30,39 @@ class ChatbotResponse:
             for rank, doc in enumerate(documents, start=1):
                 context += f"Relevant Document: {rank}::\n" + doc.page_content + "\n"
 
-        ## llm call for generating the response
-        prompt = ChatPromptTemplate.from_template(self.rag_prompt_template)
-        chain = prompt | self.model | StrOutputParser()
-        resp = chain.invoke({
+        return {
             "chat_history": memory,
             "context": context,
             "multi_hop_context": subquery_docs
-        })
+        }
 
-        return resp
\ No newline at end of file
+    def invoke(
+            self,
+            memory: ConversationSummaryMemory,
+            documents: List[Document] = [],
+            subquery_docs: str = ""
+    ):
+        ## llm call for generating the response
+        resp = self.chain.invoke(self.__prepare_inputs(memory, documents, subquery_docs))
+
+        return resp
+
+    async def ainvoke(
+            self,
+            memory: ConversationSummaryMemory,
+            documents: List[Document] = [],
+            subquery_docs: str = ""
+    ):
+        ## non-blocking llm call -> several responses can be generated concurrently
+        resp = await self.chain.ainvoke(self.__prepare_inputs(memory, documents, subquery_docs))
+
+        return resp
+
+    def stream(
+            self,
+            memory: ConversationSummaryMemory,
+            documents: List[Document] = [],
+            subquery_docs: str = ""
+    ) -> Iterator[str]:
+        ## yield the response token chunks as soon as the llm produces them
+        yield from self.chain.stream(self.__prepare_inputs(memory, documents, subquery_docs))
@@ -1,45 +1,52 @@
+import copy
 from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from typing import Union
+from typing import Optional, Union
 
 ## class for conversation memory
 class ConversationSummaryMemory:
     def __init__(self, model, k: int) -> None:
-        self.conversations = []
+        self.conversations = [] ## only the latest `window` turns, older ones live in the running summary
         self.model = model
         self.window = k*2
         self._summary_cache = ""
+        self._pretty_cache: Optional[str] = None ## pretty printed window, invalidated on every append
+        self._summary_chain = self.__initiate_chain()
     
     ## windowed conversation list
     @property
     def windowed_conversation(self):
-        if len(self.conversations) > self.window:
-            return self.conversations[-self.window:]
         return self.conversations
 
     ## method to pretty print
     @staticmethod
     def __pretty_print(conversations) -> str:
-        entire_conversation = []
-        for turn in conversations:
-            entire_conversation.append(f"> {turn.type}: {turn.content}")
-        return "\n".join(entire_conversation)
+        return "\n".join(f"> {turn.type}: {turn.content}" for turn in conversations)
+
+    ## pretty printed window, rebuilt only once per appended turn
+    def __pretty_window(self) -> str:
+        if self._pretty_cache is None:
+            self._pretty_cache = self.__pretty_print(self.windowed_conversation)
+        return self._pretty_cache
 
     ## private method for initiating a langchain chain
     def __initiate_chain(self):
         template = """
-        You are an expert in summarizing conversations between a human and an AI chatbot. Your task is to write a short, clear summary that keeps the main facts, tone, and context of the conversation intact while removing unnecessary or repetitive parts. The summary should be concise but informative enough for another system to understand what the conversation was about and its overall direction.
+        You are an expert in summarizing conversations between a human and an AI chatbot. You maintain a running summary of the conversation: merge the new turn into the existing summary so that it keeps the main facts, tone, and context intact while removing unnecessary or repetitive parts. The summary should be concise but informative enough for another system to understand what the conversation was about and its overall direction.
 
-        Input Conversation:
-        {conversation}
+        Existing Summary:
+        {prev_summary}
+
+        New Turn:
+        {new_turn}
 
         Output:
-        A brief, well-written paragraph summarizing the conversation.
+        A brief, well-written paragraph summarizing the conversation so far.
         """
         prompt = PromptTemplate(
             template=template,
-            input_variables=["conversation"]
+            input_variables=["prev_summary", "new_turn"]
         )
         chain = prompt | self.model | StrOutputParser()
         return chain
@@ -47,16 +54,22 @@ class ConversationSummaryMemory:
     ## method to add conversation one-by-one
     def append(self, conversation: Union[AIMessage, HumanMessage]) -> None:
         self.conversations.append(conversation)
+        self._pretty_cache = None
         if len(self.conversations) > self.window:
-            prev = self._summary_cache
-            total_conversation_context = (
-                "Previous Conversation Summary: " + prev
-                + "\nLatest Turns:\n" + self.__pretty_print(self.windowed_conversation)
+            ## evict only the oldest turn and fold it into the running summary -> O(1) turns per LLM call
+            evicted = self.conversations.pop(0)
+            self._summary_cache = self._summary_chain.invoke(
+                {
+                    "prev_summary": self._summary_cache or "(empty)",
+                    "new_turn": self.__pretty_print([evicted])
+                }
             )
-            chain = self.__initiate_chain()
-            self._summary_cache = chain.invoke({"conversation": total_conversation_context})
-        # else:
-        #     total_conversation_context = self.__pretty_print(self.conversations)
+
+    ## independent copy of the current history -> shares the model + summary chain (both stateless), not the turn list
+    def fork(self) -> "ConversationSummaryMemory":
+        clone = copy.copy(self)
+        clone.conversations = list(self.conversations)
+        return clone
 
     ## generate summary
     @property
@@ -65,9 +78,9 @@ class ConversationSummaryMemory:
     
     ## object print
     def __str__(self) -> str:
-      if len(self.conversations) > self.window:
-        return f"Last {self.window} turns of the Conversation:\n\n{self.__pretty_print(self.windowed_conversation)}\n\nPrevious Conversation Summary: {self.summary}"
-      return f"Latest Conversation:\n\n{self.__pretty_print(self.windowed_conversation)}"
+      if self._summary_cache:
+        return f"Last {self.window} turns of the Conversation:\n\n{self.__pretty_window()}\n\nPrevious Conversation Summary: {self.summary}"
+      return f"Latest Conversation:\n\n{self.__pretty_window()}"
     
 ## ---- TEST ----
 if __name__=="__main__":
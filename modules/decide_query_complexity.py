@@ -1,13 +1,30 @@
 ## import dependencies
+import os
+import re
+import json
+import pickle
+import asyncio
+import numpy as np
+from collections import OrderedDict
 from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.output_parsers import BaseOutputParser, JsonOutputParser
+from langchain_core.exceptions import OutputParserException
 from pydantic import BaseModel, Field
-from typing import Literal
+from typing import List, Literal, Optional, get_args
 from modules.conversation_history import ConversationSummaryMemory
+from modules.prompts import load_prompt
+from modules.semantic_cache import SemanticCache
 
 ## prompt template
-with open("./prompts/decide_query_complexity.md", "r", encoding="utf-8") as file:
-    complexity_prompt = file.read()
+complexity_prompt = load_prompt("./prompts/decide_query_complexity.md")
+## several independent queries classified in one llm call
+complexity_batch_prompt = load_prompt("./prompts/decide_query_complexity_batch.md")
+
+## greetings / thanks / farewells that never need the classifier (whole input, trailing punctuation allowed)
+_SIMPLE_RE = re.compile(
+    r"^(hi|hello|hey|thanks|thank you|thank you so much|bye|goodbye|ok|okay|yes|no|sure)( there| a lot)?[\s!.,?]*$"
+)
+_MIN_QUERY_LENGTH = 15
 
 class QueryComplexitySchema(BaseModel):
     complexity: Literal["simple_conversation", "complex", "multi_hop"] = Field(
@@ -32,36 +49,105 @@ class QueryComplexitySchema(BaseModel):
         """
     )
 
+## every tier the classifier may answer with
+_COMPLEXITY_TIERS = get_args(QueryComplexitySchema.model_fields["complexity"].annotation)
+
+class QueryComplexityBatchSchema(BaseModel):
+    complexities: List[Literal["simple_conversation", "complex", "multi_hop"]] = Field(
+        default=[],
+        description="""
+        One complexity category per user query, in the order the queries are numbered.
+        The categories mean the same as for a single query: `simple_conversation`, `complex` or `multi_hop`.
+        """
+    )
+
+## pull the tier straight out of the raw completion -> no JSON/pydantic round-trip for a one-key schema
+_COMPLEXITY_RE = re.compile(r'"complexity"\s*:\s*"(\w+)"')
+
+class ComplexityOutputParser(BaseOutputParser[dict]):
+    """
+    Minimal parser for QueryComplexitySchema:
+    -> regex match on the `complexity` key first
+    -> falls back to json.loads on the outermost {...} block (e.g. unusual spacing/escaping)
+    """
+    def parse(self, text: str) -> dict:
+        match = _COMPLEXITY_RE.search(text)
+        if match:
+            return {"complexity": match.group(1)}
+
+        start, end = text.find("{"), text.rfind("}")
+        try:
+            return {"complexity": json.loads(text[start:end + 1])["complexity"]}
+        except (ValueError, KeyError, TypeError):
+            raise OutputParserException(f"[ALERT] Could not parse query complexity from: {text}")
+
+    @property
+    def _type(self) -> str:
+        return "query_complexity"
+
 ## determine query complexity based on the user query and previous conversation
 class QueryComplexity:
     def __init__(
             self,
             model,
             prompt_template: str = complexity_prompt,
-            pydantic_schema = QueryComplexitySchema
+            pydantic_schema = QueryComplexitySchema,
+            batch_prompt_template: str = complexity_batch_prompt
     ):
         self.model = model
         self.template = prompt_template
         self.output_schema = pydantic_schema
+        ## template, model and schema are fixed -> build the chain once
+        self.chain = self.__initiate_chain(
+            template=self.template,
+            model=self.model,
+            pydantic_schema=self.output_schema
+        )
+        self.batch_chain = self.__initiate_batch_chain(template=batch_prompt_template, model=self.model)
 
     @staticmethod
     def __initiate_chain(template, model, pydantic_schema):
-        parser = JsonOutputParser(pydantic_object=pydantic_schema)
+        ## the JSON parser is only used for its format instructions, parsing goes through the regex parser
+        format_instructions = JsonOutputParser(pydantic_object=pydantic_schema).get_format_instructions()
         prompt = PromptTemplate(
             template=template,
             input_variables=["user_query", "memory"],
-            partial_variables={"format_instructions": parser.get_format_instructions()}
+            partial_variables={"format_instructions": format_instructions}
         )
-        chain = prompt | model | parser
+        chain = prompt | model | ComplexityOutputParser()
         return chain
 
+    @staticmethod
+    def __initiate_batch_chain(template, model):
+        parser = JsonOutputParser(pydantic_object=QueryComplexityBatchSchema)
+        prompt = PromptTemplate(
+            template=template,
+            input_variables=["user_queries", "memory"],
+            partial_variables={"format_instructions": parser.get_format_instructions()}
+        )
+        return prompt | model | parser
+
+    @staticmethod
+    def __is_simple(user_query: str) -> bool:
+        ## too short to carry a legal question, or pure small talk -> skip the LLM round-trip
+        query = user_query.lower().strip()
+        return len(query) < _MIN_QUERY_LENGTH or bool(_SIMPLE_RE.match(query))
+
     def invoke(self, user_query: str, memory: ConversationSummaryMemory):
-        chain = self.__initiate_chain(
-            template=self.template,
-            model=self.model,
-            pydantic_schema=self.output_schema
+        if self.__is_simple(user_query):
+            return "simple_conversation"
+        resp = self.chain.invoke(
+            {
+                "user_query": user_query,
+                "memory": memory,
+            }
         )
-        resp = chain.invoke(
+        return resp["complexity"]
+
+    async def ainvoke(self, user_query: str, memory: ConversationSummaryMemory):
+        if self.__is_simple(user_query):
+            return "simple_conversation"
+        resp = await self.chain.ainvoke(
             {
                 "user_query": user_query,
                 "memory": memory,
@@ -69,6 +155,138 @@ class QueryComplexity:
         )
         return resp["complexity"]
 
+    async def __aclassify_chunk(self, user_queries: List[str], memory: ConversationSummaryMemory) -> List[str]:
+        numbered = "\n".join(f"{position}. {query}" for position, query in enumerate(user_queries, start=1))
+        try:
+            resp = await self.batch_chain.ainvoke({"user_queries": numbered, "memory": memory})
+            tiers = resp.get("complexities") if isinstance(resp, dict) else None
+        except OutputParserException:
+            tiers = None
+
+        ## one valid tier per query or the answer can't be trusted -> classify this chunk query by query
+        if not isinstance(tiers, list) or len(tiers) != len(user_queries) or any(tier not in _COMPLEXITY_TIERS for tier in tiers):
+            print(f"[ALERT] Batched complexity answer unusable for {len(user_queries)} queries, classifying them one by one")
+            return list(await asyncio.gather(*(self.ainvoke(user_query=query, memory=memory) for query in user_queries)))
+        return tiers
+
+    async def aclassify_batch(self, user_queries: List[str], memory: ConversationSummaryMemory, batch_size: int = 25) -> List[str]:
+        """
+        Tiers for many independent queries sharing one memory:
+        -> small talk is answered by the rule-based check, the rest goes to the llm `batch_size` queries per call
+        -> returns one tier per query, in the input order
+        """
+        tiers: List[Optional[str]] = ["simple_conversation" if self.__is_simple(query) else None for query in user_queries]
+        pending = [position for position, tier in enumerate(tiers) if tier is None]
+        chunks = [pending[start:start + batch_size] for start in range(0, len(pending), batch_size)]
+
+        results = await asyncio.gather(
+            *(self.__aclassify_chunk([user_queries[position] for position in chunk], memory) for chunk in chunks)
+        )
+        for chunk, chunk_tiers in zip(chunks, results):
+            for position, tier in zip(chunk, chunk_tiers):
+                tiers[position] = tier
+        return tiers
+
+    def classify_batch(self, user_queries: List[str], memory: ConversationSummaryMemory, batch_size: int = 25) -> List[str]:
+        return asyncio.run(self.aclassify_batch(user_queries=user_queries, memory=memory, batch_size=batch_size))
+
+class CachedComplexity:
+    """
+    Complexity decisions cached per query, for callers whose memory is the same on every call (e.g. ragas_eval.py):
+    -> exact layer: LRU keyed by the lowercased, whitespace-collapsed query
+    -> semantic layer (with `embedding_function`): a paraphrase with cosine >= threshold reuses the earlier tier
+    -> with `cache_path`, decisions are pickled by .save() and loaded again on the next run
+    -> only misses reach the wrapped QueryComplexity (one llm call)
+    -> aprefetch(queries) classifies all misses of a known query set up front, batched (one llm call per `batch_size` queries)
+    """
+    def __init__(
+            self,
+            complexity_decider: QueryComplexity,
+            embedding_function = None,
+            threshold: float = 0.95,
+            maxsize: int = 4096,
+            cache_path: Optional[str] = None,
+            dim: int = 384
+    ) -> None:
+        self.complexity_decider = complexity_decider
+        self.embedding_function = embedding_function
+        self.maxsize = maxsize
+        self.cache_path = cache_path
+        self._exact: "OrderedDict[str, str]" = OrderedDict()
+        self._semantic = SemanticCache(
+            embedding_function=embedding_function,
+            threshold=threshold,
+            max_size=maxsize,
+            ttl=float("inf"),
+            dim=dim
+        ) if embedding_function is not None else None
+
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, "rb") as f:
+                for query, tier in pickle.load(f).items():
+                    self.__store(query, tier)
+
+    @staticmethod
+    def __normalize(user_query: str) -> str:
+        return " ".join(user_query.lower().split())
+
+    def __store(self, query: str, tier: str, q_vec: Optional[np.ndarray] = None) -> None:
+        self._exact[query] = tier
+        self._exact.move_to_end(query)
+        if len(self._exact) > self.maxsize:
+            self._exact.popitem(last=False) ## evict the least recently used decision
+        if self._semantic is not None:
+            self._semantic.add(q_vec if q_vec is not None else self._semantic.embed(query), tier)
+
+    async def ainvoke(self, user_query: str, memory: ConversationSummaryMemory) -> str:
+        query = self.__normalize(user_query)
+        if query in self._exact:
+            self._exact.move_to_end(query)
+            return self._exact[query]
+
+        q_vec = None
+        if self._semantic is not None:
+            q_vec = await asyncio.to_thread(self._semantic.embed, query)
+            tier = self._semantic.lookup(q_vec)
+            if tier is not None:
+                return tier
+
+        tier = await self.complexity_decider.ainvoke(user_query=user_query, memory=memory)
+        self.__store(query, tier, q_vec)
+        return tier
+
+    def invoke(self, user_query: str, memory: ConversationSummaryMemory) -> str:
+        return asyncio.run(self.ainvoke(user_query=user_query, memory=memory))
+
+    async def aprefetch(self, user_queries: List[str], memory: ConversationSummaryMemory, batch_size: int = 25) -> None:
+        ## unique queries neither cache layer knows yet -> the later ainvoke calls are exact hits
+        misses = {}
+        for user_query in user_queries:
+            query = self.__normalize(user_query)
+            if query in self._exact or query in misses:
+                continue
+            q_vec = None
+            if self._semantic is not None:
+                q_vec = await asyncio.to_thread(self._semantic.embed, query)
+                if self._semantic.lookup(q_vec) is not None:
+                    continue
+            misses[query] = (user_query, q_vec)
+        if not misses:
+            return
+
+        tiers = await self.complexity_decider.aclassify_batch(
+            [user_query for user_query, _ in misses.values()], memory=memory, batch_size=batch_size
+        )
+        for (query, (_, q_vec)), tier in zip(misses.items(), tiers):
+            self.__store(query, tier, q_vec)
+
+    def save(self) -> None:
+        if not self.cache_path:
+            return
+        os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+        with open(self.cache_path, "wb") as f:
+            pickle.dump(dict(self._exact), f, protocol=pickle.HIGHEST_PROTOCOL)
+
 ## --- TEST EXECUTION ---
 if __name__ == "__main__":
     from langchain_cohere import ChatCohere
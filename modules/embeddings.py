@@ -0,0 +1,21 @@
+## import dependencies
+import os
+from functools import lru_cache
+from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+
+DEFAULT_EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+## one loaded model per name for the whole process -> app, evaluation and test blocks share the weights
+@lru_cache(maxsize=None)
+def get_embedder(model_name: str = DEFAULT_EMBEDDING_MODEL) -> HuggingFaceEmbeddings:
+    import torch
+
+    ## leave half the cores to FAISS's OpenMP threads -> no oversubscription during retrieval
+    torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    ## normalized output -> cosine == inner product, matches the IP indexes of the vector store
+    return HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={"device": device},
+        encode_kwargs={"normalize_embeddings": True, "batch_size": 64}
+    )
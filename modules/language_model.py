@@ -1,9 +1,14 @@
 ## import dependencies
 # from langchain_google_genai import ChatGoogleGenerativeAI
+import cohere
+import httpx
 from langchain_cohere import ChatCohere
 from langchain_ollama import ChatOllama
 from langchain_ollama.embeddings import OllamaEmbeddings
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+from modules.embeddings import get_embedder, DEFAULT_EMBEDDING_MODEL
+from modules.cached_embeddings import CachedEmbeddings, EMBEDDING_CACHE_PATH, collapse_query
+from modules.light_dense_encoder import LightEmbeddings
+from modules.onnx_embeddings import OnnxEmbeddings, ONNX_MODEL_PATH
 
 ## environment setup
 import os
@@ -20,13 +25,52 @@ cohere_api = os.getenv("COHERE_API_KEY", None)
 assert cohere_api, "[ATTENTION] COHERE API KEY IS MISSING!"
 os.environ["COHERE_API_KEY"] = cohere_api
 
+## one keep-alive connection pool per transport for every Cohere chat model
+## -> llm / cheap_llm reuse the same warm TLS connections instead of each opening (and handshaking) their own
+## (the async pool is bound to the event loop that opens its connections -> callers drive all async calls from one loop:
+##  app.py through one asyncio.Runner for the session, ragas_eval.py through a single asyncio.run)
+COHERE_HTTP_LIMITS = httpx.Limits(max_connections=64, max_keepalive_connections=32)
+cohere_http_client = httpx.Client(timeout=300, limits=COHERE_HTTP_LIMITS)
+cohere_async_http_client = httpx.AsyncClient(timeout=300, limits=COHERE_HTTP_LIMITS)
+
+def share_cohere_pool(chat_model: ChatCohere) -> ChatCohere:
+    ## same settings ChatCohere builds its sdk clients with, only the transport is the shared one
+    client_kwargs = dict(
+        api_key=chat_model.cohere_api_key.get_secret_value() if chat_model.cohere_api_key else None,
+        client_name=chat_model.user_agent,
+        timeout=chat_model.timeout_seconds,
+        base_url=chat_model.base_url
+    )
+    chat_model.client = cohere.Client(**client_kwargs, httpx_client=cohere_http_client)
+    chat_model.async_client = cohere.AsyncClient(**client_kwargs, httpx_client=cohere_async_http_client)
+    return chat_model
+
 ## chat model
-llm = ChatCohere(temperature=0.0)
+llm = share_cohere_pool(ChatCohere(temperature=0.0))
+
+## smaller chat model for turns that need no retrieval (simple conversation) -> cheaper + faster than `llm`
+cheap_llm = share_cohere_pool(ChatCohere(model=os.getenv("COHERE_CHEAP_MODEL", "command-r7b-12-2024"), temperature=0.0))
+
+## embedding model, int8 ONNX Runtime backend once exported with `scripts/export_quantize_minilm.py`
+if os.getenv("USE_ONNX_ENCODER", "false").lower() == "true":
+    base_embedF = OnnxEmbeddings(model_path=ONNX_MODEL_PATH, model_name=DEFAULT_EMBEDDING_MODEL)
+else:
+    base_embedF = get_embedder(DEFAULT_EMBEDDING_MODEL) ## shared, already-loaded instance
+
+## light query encoder -> token-embedding lookup instead of a transformer pass per query
+if os.getenv("USE_LIGHT_ENCODER", "false").lower() == "true":
+    base_embedF = LightEmbeddings(embedding_function=base_embedF, model_name=DEFAULT_EMBEDDING_MODEL)
+
+## warm-up forward pass at startup -> the first user turn doesn't pay for tokenizer/kernel initialisation
+base_embedF.embed_query("warmup")
 
-## embedding model
-embedF = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+## memoized (in memory + on disk) so repeated queries skip the embedding call, also across sessions
+## MiniLM's tokenizer is uncased -> case / whitespace variants of a query share one cache entry
+embedF = CachedEmbeddings(base_embedF, maxsize=2048, cache_path=EMBEDDING_CACHE_PATH, query_normalizer=collapse_query)
 
 ## chat model for ragas evaluation
 # ragas_eval_llm = ChatGoogleGenerativeAI(model="gemini-2.0-flash-lite")
 ragas_eval_llm = ChatOllama(model="qwen2.5:latest")
-ragas_eval_embedF = OllamaEmbeddings(model="nomic-embed-text:latest")
\ No newline at end of file
+## ragas embeds the same retrieved chunks / answers for many rows -> every distinct text is embedded once per scoring run
+## no query normalizer: nomic-embed-text's tokenizer is cased
+ragas_eval_embedF = CachedEmbeddings(OllamaEmbeddings(model="nomic-embed-text:latest"), maxsize=4096)
\ No newline at end of file
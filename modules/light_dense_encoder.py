@@ -0,0 +1,95 @@
+## import dependencies
+import os
+import numpy as np
+from typing import List
+from langchain_core.embeddings import Embeddings
+from transformers import AutoTokenizer
+
+## setup PATH
+LIGHT_ENCODER_PATH = "./data/light_encoder"
+
+def build_token_embeddings(model_name: str, output_path: str, batch_size: int = 512) -> np.ndarray:
+    """
+    Precompute the [V, d] token-embedding matrix E once:
+    -> every vocabulary token is fed through the full model as `[CLS] token [SEP]`
+    -> the mean-pooled last hidden state becomes its row in E, saved to `output_path/E.npy`
+    """
+    import torch
+    from transformers import AutoModel
+
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name).eval()
+
+    vocab_size = len(tokenizer)
+    token_embeddings = np.zeros((vocab_size, model.config.hidden_size), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, vocab_size, batch_size):
+            token_ids = torch.arange(start, min(start + batch_size, vocab_size))
+            input_ids = torch.stack(
+                [torch.full_like(token_ids, tokenizer.cls_token_id), token_ids, torch.full_like(token_ids, tokenizer.sep_token_id)],
+                dim=1
+            )
+            hidden = model(input_ids=input_ids, attention_mask=torch.ones_like(input_ids)).last_hidden_state
+            token_embeddings[start:start + len(token_ids)] = hidden.mean(dim=1).numpy() ## same mean pooling as sentence-transformers
+
+    os.makedirs(output_path, exist_ok=True)
+    np.save(os.path.join(output_path, "E.npy"), token_embeddings)
+    return token_embeddings
+
+class LightEmbeddings(Embeddings):
+    """
+    LightRetriever style asymmetric encoder:
+    -> documents are still embedded by the full model, so the existing vector store stays valid
+    -> queries skip the transformer entirely: embed_query(text) = normalize(E[token_ids].mean(0))
+    -> E is built once (see `build_token_embeddings`) and memory-mapped afterwards
+    """
+    def __init__(
+            self,
+            embedding_function: Embeddings,
+            model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+            matrix_path: str = LIGHT_ENCODER_PATH
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+
+        matrix_file = os.path.join(matrix_path, "E.npy")
+        if not os.path.exists(matrix_file):
+            build_token_embeddings(model_name=model_name, output_path=matrix_path)
+        ## if already exists, skip building
+        self.token_embeddings = np.load(matrix_file, mmap_mode="r")
+
+    def embed_query(self, text: str) -> List[float]:
+        token_ids = self.tokenizer(text, add_special_tokens=False, truncation=True)["input_ids"]
+        if not token_ids:
+            return self.embedding_function.embed_query(text)
+
+        q_vec = np.asarray(self.token_embeddings[token_ids]).mean(axis=0)
+        return (q_vec / (np.linalg.norm(q_vec) or 1.0)).tolist()
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        ## batch variant of embed_query -> CachedEmbeddings.prime_queries keeps the asymmetric query path
+        return [self.embed_query(text) for text in texts]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embedding_function.embed_documents(texts)
+
+## ---- TEST ----
+if __name__=="__main__":
+    import time
+    from modules.embeddings import get_embedder
+
+    full_encoder = get_embedder()
+    light_encoder = LightEmbeddings(embedding_function=full_encoder)
+
+    user_query = "Which section of the Special Marriage Act sets the minimum age of the parties?"
+
+    start = time.perf_counter()
+    full_vec = np.asarray(full_encoder.embed_query(user_query))
+    print(f"> Full encoder: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    light_vec = np.asarray(light_encoder.embed_query(user_query))
+    print(f"> Light encoder: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    print(f"> Cosine(full, light): {float(full_vec @ light_vec / np.linalg.norm(full_vec)):.4f}")
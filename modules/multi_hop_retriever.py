@@ -1,17 +1,22 @@
 ## import dependencies
+import asyncio
+import numpy as np
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from langchain_core.prompts import PromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
 from langchain.schema import Document
 from pydantic import BaseModel, Field
-from typing import Dict, List
+from typing import Callable, Dict, List, Optional, Tuple
 
 from ragas.messages import HumanMessage, AIMessage
 
 from modules.conversation_history import ConversationSummaryMemory
 from modules.rrf_score import RRF
+from modules.semantic_cache import SemanticCache
+from modules.prompts import load_prompt
 
-with open("./prompts/multihop-prompt.md", "r", encoding="utf-8") as f:
-    multihop_template = f.read()
+multihop_template = load_prompt("./prompts/multihop-prompt.md")
 
 class SubQuery(BaseModel):
     end_of_generation: bool = Field(
@@ -32,90 +37,221 @@ class SubQuery(BaseModel):
         """
     )
 
+## schema is fixed at import -> parser + format instructions are built once for the default schema
+_DEFAULT_PARSER = JsonOutputParser(pydantic_object=SubQuery)
+_DEFAULT_FORMAT_INSTRUCTIONS = _DEFAULT_PARSER.get_format_instructions()
+
+## ~4 characters per token for English prose -> close enough for budgeting, no tokenizer download / API call
+def approx_token_count(text: str) -> int:
+    return len(text) // 4 + 1
+
+## per-request state of one multi-hop run -> the retriever itself only holds shared config, chain and caches
+@dataclass
+class HopState:
+    subqueries: List[str] = field(default_factory=list)
+    retrieved: List[List[Document]] = field(default_factory=list)
+    content_buf: List[str] = field(default_factory=lambda: ["### Subqueries + Retrieved Documents\n"]) ## grown by one block per hop
+    block_tokens: List[int] = field(default_factory=list) ## token count per block in `content_buf[1:]`
+    seen_hashes: set = field(default_factory=set) ## page_content hashes already shown in an earlier hop
+    subq_embeddings: List[np.ndarray] = field(default_factory=list) ## normalized embeddings of the accepted subqueries
+    subquery_cache: Optional[SemanticCache] = None ## near-duplicate subqueries of this request only
+
 ## define multi-hop retriever class
 class MultiHopRetriever:
+    """
+    Multi-hop retriever:
+    -> one instance can serve many concurrent requests, every call works on its own HopState
+    -> shared across requests: the planner chain, both retrievers and the exact-match retrieval LRU
+    """
     def __init__(
             self,
             model,
             bm25_retriever,
             semantic_retriever,
             multi_hop_prompt_template: str = multihop_template,
-            pydantic_schema = SubQuery
+            pydantic_schema = SubQuery,
+            retrieval_cache_size: int = 512,
+            embedding_function = None,
+            subquery_similarity_threshold: float = 0.92,
+            subquery_cache_ttl: float = 300,
+            convergence_threshold: float = 0.95,
+            max_context_tokens: int = 6000,
+            token_counter: Callable[[str], int] = approx_token_count
     ):
         self.multi_hop_prompt_template = multi_hop_prompt_template
         self.model = model
         self.bm25_retriever = bm25_retriever
         self.semantic_retriever = semantic_retriever
         self.pydantic_schema = pydantic_schema
+        ## template, model and schema never change between hops -> build the chain once
+        self._chain = self.__initiate_chain(
+            template=self.multi_hop_prompt_template,
+            model=self.model,
+            pydantic_schema=self.pydantic_schema
+        )
+
+        ## token budget of the subqueries + documents block, oldest hops fall out first
+        self.max_context_tokens = max_context_tokens
+        self.token_counter = token_counter
 
-        ## queries and documents
-        self.end_of_generation = False
-        self.subqueries = []
-        self.retrieved_respective_documents = []
+        ## exact-match LRU: normalized subquery -> (bm25_docs, dense_docs), safe to share since retrieval is deterministic
+        self.retrieval_cache_size = retrieval_cache_size
+        self._retrieval_cache: "OrderedDict[str, Tuple[List[Document], List[Document]]]" = OrderedDict()
 
-    def generate_subquery_content(self) -> str:
-        starting_substring = "### Subqueries + Retrieved Documents\n"
-        content = ""
-        for index, (subquery, list_of_documents) in enumerate({subquery: list_of_docs for subquery, list_of_docs in zip(self.subqueries, self.retrieved_respective_documents)}.items(), start=1):
-            content += f"{index}. Subquery: {subquery}\n-> Relevant Documents:\n{'\n'.join(doc.page_content for doc in list_of_documents)}"
-            content +="\n"
-        return starting_substring+content
+        ## semantic layer for near-duplicate subqueries, embeds with the dense retriever's own model by default
+        vectorstore = getattr(semantic_retriever, "vectorstore", None)
+        self.embedding_function = embedding_function or getattr(vectorstore, "embeddings", None)
+        self.subquery_similarity_threshold = subquery_similarity_threshold
+        self.subquery_cache_ttl = subquery_cache_ttl
+        self._subquery_dim = vectorstore.index.d if vectorstore is not None else 384
+
+        ## early exit once the planner starts repeating itself
+        self.convergence_threshold = convergence_threshold
+
+    def new_state(self) -> HopState:
+        subquery_cache = None
+        if self.embedding_function is not None:
+            subquery_cache = SemanticCache(
+                embedding_function=self.embedding_function,
+                threshold=self.subquery_similarity_threshold,
+                max_size=self.retrieval_cache_size,
+                ttl=self.subquery_cache_ttl,
+                dim=self._subquery_dim
+            )
+        return HopState(subquery_cache=subquery_cache)
+
+    def __append_hop(self, state: HopState, subquery: str, list_of_documents: List[Document]) -> None:
+        ## a chunk already shown under an earlier hop is dropped -> prompt tokens don't grow with repeated evidence
+        list_of_documents = [doc for doc in list_of_documents if hash(doc.page_content) not in state.seen_hashes]
+        state.seen_hashes.update(hash(doc.page_content) for doc in list_of_documents)
+
+        ## earlier blocks never change -> only format the newest (subquery, documents) pair
+        state.subqueries.append(subquery)
+        state.retrieved.append(list_of_documents)
+        block = (
+            f"{len(state.subqueries)}. Subquery: {subquery}\n-> Relevant Documents:\n"
+            + "\n".join(doc.page_content for doc in list_of_documents)
+            + "\n"
+        )
+        state.content_buf.append(block)
+        state.block_tokens.append(self.token_counter(block))
+
+    def generate_subquery_content(self, state: HopState) -> str:
+        ## walk from the most recent hop backwards while the budget allows, the newest hop is always kept
+        header, blocks = state.content_buf[0], state.content_buf[1:]
+        budget = self.max_context_tokens - self.token_counter(header)
+        first_kept = len(blocks)
+        for index in range(len(blocks) - 1, -1, -1):
+            budget -= state.block_tokens[index]
+            if budget < 0 and first_kept < len(blocks):
+                break
+            first_kept = index
+        return header + "".join(blocks[first_kept:])
 
     @staticmethod
     def __initiate_chain(template, model, pydantic_schema) -> Dict:
-        parser = JsonOutputParser(pydantic_object=pydantic_schema)
+        if pydantic_schema is SubQuery:
+            parser, format_instructions = _DEFAULT_PARSER, _DEFAULT_FORMAT_INSTRUCTIONS
+        else:
+            parser = JsonOutputParser(pydantic_object=pydantic_schema)
+            format_instructions = parser.get_format_instructions()
         prompt = PromptTemplate(
             template=template,
             input_variables=["max_iteration_allowed", "user_query", "memory", "subqueries_and_relevant_documents"],
-            partial_variables={"format_instructions": parser.get_format_instructions()}
+            partial_variables={"format_instructions": format_instructions}
         )
         chain = prompt | model | parser
         return chain
 
-    def invoke(self, user_query, memory: ConversationSummaryMemory, max_iteration_allowed=5):
-        for i in range(max_iteration_allowed):
-            # print(f"> Try: {i}") ## for debugging
-            chain = self.__initiate_chain(
-                template=self.multi_hop_prompt_template,
-                model=self.model,
-                pydantic_schema=self.pydantic_schema
-            )
-            resp = chain.invoke(
-                {
-                    "max_iteration_allowed": max_iteration_allowed,                    "memory": memory,
-                    "user_query": user_query,
-                    "memory": memory,
-                    "subqueries_and_relevant_documents": self.generate_subquery_content() if len(self.subqueries) > 0 else ""
-                }
-            )
+    async def __plan_next_hop(self, state: HopState, user_query, memory: ConversationSummaryMemory, max_iteration_allowed: int) -> Dict:
+        ## same order as the prompt variables (format_instructions comes in as a partial)
+        payload = {
+            "max_iteration_allowed": max_iteration_allowed,
+            "memory": memory,
+            "user_query": user_query,
+            "subqueries_and_relevant_documents": self.generate_subquery_content(state) if len(state.subqueries) > 0 else ""
+        }
+        return await self._chain.ainvoke(payload)
+
+    async def __has_converged(self, state: HopState, subquery: str) -> bool:
+        if self.embedding_function is None:
+            return False
+        q_vec = np.asarray(await asyncio.to_thread(self.embedding_function.embed_query, subquery), dtype=np.float32)
+        q_vec /= (np.linalg.norm(q_vec) or 1.0)
 
-            ## for debugging
-            print(f"> EoG Status: {resp['end_of_generation']}")
-            print(f"> Subquery: {resp['subquery']}")
-
-            if not resp['end_of_generation']:
-                """
-                If the LLM has to continue generating more
-                subqueries:
-                -> append every subquery
-                -> retrieve relevant documents using both retriever
-                -> pack it in a List[List[Document]]
-                -> fetch best documents via RRF
-                -> append it to `retrieved_respective_documents`
-                """
-                self.subqueries.append(resp['subquery'])
-                rrf = RRF(
-                    [
-                        self.bm25_retriever.invoke(resp['subquery']),  ## output -> List[Document]
-                        self.semantic_retriever.invoke(resp['subquery']),  ## output -> List[Document]
-                    ]  ## becomes: List[List[Document]]
-                )
-                best_relevant_docs = rrf.rearrange(top_k=7) ## -> List[Document]
-                self.retrieved_respective_documents.append(best_relevant_docs)
+        converged = bool(state.subq_embeddings) and float(np.max(np.vstack(state.subq_embeddings) @ q_vec)) > self.convergence_threshold
+        if not converged:
+            state.subq_embeddings.append(q_vec)
+        return converged
+
+    async def __retrieve_hop(self, state: HopState, subquery: str) -> List[Document]:
+        """
+        -> retrieve relevant documents using both retriever concurrently
+        -> repeated subqueries (same text after strip + lower) are served from the LRU, no BM25/embedding/ANN call
+        -> near-duplicate subqueries (cosine >= threshold) reuse the documents of the earlier hop
+        -> fetch best documents via RRF
+        """
+        key = subquery.strip().lower()
+        if key in self._retrieval_cache:
+            self._retrieval_cache.move_to_end(key)
+            bm25_docs, dense_docs = self._retrieval_cache[key]
+        else:
+            q_vec, cached = None, None
+            if state.subquery_cache is not None:
+                ## the query embedding is memoized -> the dense retriever below doesn't embed it a second time
+                q_vec = await asyncio.to_thread(state.subquery_cache.embed, subquery)
+                cached = state.subquery_cache.lookup(q_vec)
+
+            if cached is not None:
+                bm25_docs, dense_docs = cached
             else:
+                bm25_docs, dense_docs = await asyncio.gather(
+                    self.bm25_retriever.ainvoke(subquery),  ## BaseRetriever.ainvoke -> sync BM25 scoring runs in the default executor
+                    self.semantic_retriever.ainvoke(subquery)
+                )  ## output -> List[Document], List[Document]
+                if q_vec is not None:
+                    state.subquery_cache.add(q_vec, (bm25_docs, dense_docs))
+
+            self._retrieval_cache[key] = (bm25_docs, dense_docs)
+            if len(self._retrieval_cache) > self.retrieval_cache_size:
+                self._retrieval_cache.popitem(last=False)
+        rrf = RRF([bm25_docs, dense_docs])  ## becomes: List[List[Document]]
+        return rrf.rearrange(top_k=7) ## -> List[Document]
+
+    async def ainvoke(self, user_query, memory: ConversationSummaryMemory, max_iteration_allowed=5, state: Optional[HopState] = None) -> str:
+        """
+        Hops run as plan(k) -> [convergence check(k) || retrieve(k)] -> plan(k+1) -> ...
+        -> the planner for hop k+1 only reads subqueries + documents (no per-hop answer),
+           so it is fired as soon as hop k's documents land
+        -> hop k's retrieval is started as a task before its convergence check is awaited,
+           so the subquery embedding for the check and the BM25 + dense retrieval overlap
+        -> inside a hop BM25 and dense retrieval run concurrently
+        -> a subquery with cosine > convergence_threshold to an earlier one ends the loop early
+           (its in-flight retrieval is cancelled and never appended)
+        -> pass your own `state` to inspect subqueries / documents afterwards, otherwise a fresh one is used
+        """
+        state = state if state is not None else self.new_state()
+        resp = await self.__plan_next_hop(state, user_query, memory, max_iteration_allowed)
+        for i in range(max_iteration_allowed):
+            # print(f"> Try: {i}") ## for debugging
+            if resp['end_of_generation']:
                 break
+            ## speculative -> retrieval doesn't depend on the convergence verdict, so it runs while the check embeds the subquery
+            retrieval = asyncio.create_task(self.__retrieve_hop(state, resp['subquery']))
+            ## only a rephrasing of an earlier subquery -> no new evidence to gather, stop planning
+            if await self.__has_converged(state, resp['subquery']):
+                retrieval.cancel()
+                break
+
+            self.__append_hop(state, resp['subquery'], await retrieval)
+
+            if i + 1 < max_iteration_allowed:
+                resp = await self.__plan_next_hop(state, user_query, memory, max_iteration_allowed)
         ## fetch subquery -> fetch relevant docs -> generate content -> return content
-        return self.generate_subquery_content()
+        return self.generate_subquery_content(state)
+
+    def invoke(self, user_query, memory: ConversationSummaryMemory, max_iteration_allowed=5, state: Optional[HopState] = None) -> str:
+        return asyncio.run(self.ainvoke(user_query=user_query, memory=memory, max_iteration_allowed=max_iteration_allowed, state=state))
 
 ##---- TESTING EXECUTION ----
 if __name__ == "__main__":
@@ -123,7 +259,7 @@ if __name__ == "__main__":
     from modules.bm25_retriever import instantiate_bm25retriever
     from modules.semantic_retriever import SemanticRetriever
     from modules.preprocess_documents import load_chunk_store
-    from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+    from modules.embeddings import get_embedder
 
     INPUT_DATA_PATH = "./data/raw"
     OUTPUT_DATA_PATH = "./data/vectors"
@@ -140,7 +276,7 @@ if __name__ == "__main__":
     preprocessed_docs = load_chunk_store(data_path=INPUT_DATA_PATH)
     sparse_retriever = instantiate_bm25retriever(documents=preprocessed_docs)
 
-    embedF = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    embedF = get_embedder()
     dense_retriever = SemanticRetriever(
         embedding_function=embedF,
         prepped_docs=preprocessed_docs,
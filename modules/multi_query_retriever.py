@@ -1,15 +1,21 @@
 ## import dependencies
-from langchain.prompts import PromptTemplate
+import asyncio
+from dataclasses import dataclass, field
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import JsonOutputParser
+from langchain_core.runnables import RunnableGenerator
 from pydantic import BaseModel, Field
 from modules.conversation_history import ConversationSummaryMemory
-from typing import List
+from typing import List, Optional, Tuple
 from langchain.schema import Document
 from modules.rrf_score import RRF
+from modules.semantic_cache import SemanticCache
+from modules.prompts import load_prompt
 
-## multi query prompt
-with open("./prompts/multiQuery-prompt.md", "r") as f:
-    multiquery_template = f.read()
+## multi query prompt -> static system part (instructions + format instructions), identical on every turn
+multiquery_template = load_prompt("./prompts/multiQuery-prompt.md")
+## per-turn part, sent as the human message after the cacheable system prefix
+multiquery_input_template = "## Input\n- **Chat History**: {chat_history}\n- **Latest User Query**: {user_query}"
 
 ## defined schema for the multiquery queries
 class MultiQuerySchema(BaseModel):
@@ -21,6 +27,12 @@ class MultiQuerySchema(BaseModel):
             """
         )
 
+## per-call results -> one shared MultiQueryRetriever serves concurrent turns / eval rows without mixing them up
+@dataclass
+class MultiQueryState:
+    sub_queries: List[str] = field(default_factory=list) ## empty when the docs cache answered the call
+    usage_metadata: Optional[dict] = None ## token usage of the expansion call (incl. cached input tokens, if reported)
+
 ## defined class
 class MultiQueryRetriever:
     def __init__(
@@ -30,7 +42,8 @@ class MultiQueryRetriever:
             semantic_retriever,
             multiquery_prompt_template: str = multiquery_template,
             top_k=3,
-            output_schema = MultiQuerySchema
+            output_schema = MultiQuerySchema,
+            docs_cache: Optional[SemanticCache] = None
     ) -> None:
         self.model = model
         self.bm25_retriever = bm25_retriever
@@ -38,38 +51,141 @@ class MultiQueryRetriever:
         self.multiquery_prompt_template = multiquery_prompt_template
         self.output_schema = output_schema
         self.top_k = top_k
+        ## user query -> fused best docs, shared across turns (pass one instance to every retriever built per turn)
+        ## a paraphrased query above the cache threshold skips the subquery generation + retrieval + RRF entirely
+        self.docs_cache = docs_cache
+
+        ## template, model and schema never change between turns -> bind the schema / render the format instructions + build the chain once
+        self._chain = self.__create_multiquery_chain()
+
+    def new_state(self) -> MultiQueryState:
+        return MultiQueryState()
 
-        self.sub_queries: List[str] = []
-        self.all_documents: List[List[Document]] = []
+    @staticmethod
+    async def __record_usage(chunks, config):
+        ## streaming pass-through tap between model and parser -> token usage stays observable
+        ## (providers report it on the final chunk, so the latest non-empty value wins)
+        ## the call's state travels in the run config -> the shared chain never holds per-call results
+        state = config.get("configurable", {}).get("multiquery_state")
+        async for chunk in chunks:
+            if state is not None:
+                state.usage_metadata = getattr(chunk, "usage_metadata", None) or state.usage_metadata
+            yield chunk
+
+    def __structured_model(self):
+        ## native tool / structured-output API when the chat model has one -> typed result, no JSON in the decoded text
+        try:
+            return self.model.with_structured_output(self.output_schema)
+        except (AttributeError, NotImplementedError): ## plain LLMs / chat models without tool calling
+            return None
 
     def __create_multiquery_chain(self):
-        parser = JsonOutputParser(pydantic_object=self.output_schema)
-        prompt = PromptTemplate(
-            template=self.multiquery_prompt_template ,
-            input_variables=["chat_history", "user_query"],
-            partial_variables={"format_instructions": parser.get_format_instructions()}
+        ## static instructions first as the system message, dynamic chat history + query last
+        ## -> providers with prefix caching reuse the system part across turns
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", self.multiquery_prompt_template),
+                ("human", multiquery_input_template)
+            ]
         )
-        chain = prompt | self.model | parser
+
+        structured_model = self.__structured_model()
+        if structured_model is not None:
+            ## schema travels as the tool spec -> no format instructions in the prompt
+            ## (usage metadata is not surfaced on this path, the structured runnable only yields parsed objects)
+            return prompt.partial(format_instructions="") | structured_model
+
+        parser = JsonOutputParser(pydantic_object=self.output_schema)
+        prompt = prompt.partial(format_instructions=parser.get_format_instructions())
+        chain = prompt | self.model | RunnableGenerator(self.__record_usage) | parser
         return chain
 
-    def __translate_queries(self, user_query, memory) -> None:
-        chain = self.__create_multiquery_chain()
-        resp = chain.invoke({"chat_history": memory, "user_query": user_query})
-        self.sub_queries.extend(resp.get("generatedQueries", [""]) if isinstance(resp, dict) else [""])
-
-    def __retrieve(self) -> None:
-        for query in self.sub_queries:
-            # print(f"> Subquery: {query}") ## for debugging
-            relevant_docs = self.bm25_retriever.invoke(query) + self.semantic_retriever.invoke(query) ## List[Document]
-            self.all_documents.append(relevant_docs)
-
-    def invoke(self, user_query: str, memory: ConversationSummaryMemory) -> List[Document]:
-        self.__translate_queries(user_query, memory)
-        self.__retrieve()
-        rrf = RRF(self.all_documents)
+    async def __retrieve_one(self, query: str) -> List[Document]:
+        ## BM25 has no native async so it runs in a worker thread, alongside the dense search
+        bm25_docs, dense_docs = await asyncio.gather(
+            asyncio.to_thread(self.bm25_retriever.invoke, query),
+            self.semantic_retriever.ainvoke(query)
+        )
+        return bm25_docs + dense_docs ## List[Document]
+
+    async def __retrieve_many(self, queries: List[str]) -> List[List[Document]]:
+        ## several subqueries at once -> one batched BM25 pass + one batched embedding / FAISS search
+        batched = hasattr(self.bm25_retriever, "retrieve_many") and hasattr(self.semantic_retriever, "retrieve_many")
+        if len(queries) == 1 or not batched:
+            return list(await asyncio.gather(*(self.__retrieve_one(query) for query in queries)))
+        bm25_docs, dense_docs = await asyncio.gather(
+            asyncio.to_thread(self.bm25_retriever.retrieve_many, queries),
+            asyncio.to_thread(self.semantic_retriever.retrieve_many, queries)
+        )
+        return [sparse + dense for sparse, dense in zip(bm25_docs, dense_docs)]
+
+    async def __translate_and_retrieve(self, user_query, memory, state: MultiQueryState) -> Tuple[List[str], List[List[Document]]]:
+        """
+        Stream the subqueries out of the LLM and retrieve while it is still decoding:
+        -> the JSON parser yields the growing `generatedQueries` list on every chunk
+        -> every string but the last one is complete -> its sparse + dense retrieval starts right away
+        -> the remaining ones are dispatched together once the stream ends (batched), so latency ~ max(LLM, retrieval) instead of the sum
+        -> tasks are gathered in dispatch order, so `all_documents[i]` always belongs to `queries[i]`
+        """
+        tasks = []
+        queries: List[str] = []
+        async for resp in self._chain.astream(
+                {"chat_history": memory, "user_query": user_query},
+                config={"configurable": {"multiquery_state": state}}
+        ):
+            if isinstance(resp, BaseModel):
+                resp = resp.model_dump() ## structured output yields (partial) schema instances
+            generated = resp.get("generatedQueries") if isinstance(resp, dict) else None
+            if not isinstance(generated, list):
+                continue
+            queries = [query for query in generated if isinstance(query, str)]
+            for query in queries[len(tasks):-1]:
+                # print(f"> Subquery: {query}") ## for debugging
+                tasks.append(asyncio.create_task(self.__retrieve_one(query)))
+
+        queries = queries or [""] ## unparsable response -> same fallback as before
+        ## structured output usually arrives in one piece -> most (or all) subqueries end up in this batch
+        remaining = asyncio.create_task(self.__retrieve_many(queries[len(tasks):]))
+
+        all_documents = list(await asyncio.gather(*tasks))
+        all_documents.extend(await remaining)
+        return queries, all_documents
+
+    async def ainvoke(
+            self,
+            user_query: str,
+            memory: ConversationSummaryMemory,
+            prefetched_docs: Optional[List[Document]] = None,
+            state: Optional[MultiQueryState] = None
+    ) -> List[Document]:
+        """
+        -> pass your own `state` to read the subqueries / token usage of this call afterwards, otherwise a fresh one is used
+        """
+        state = state if state is not None else self.new_state()
+        q_vec = None
+        if self.docs_cache is not None:
+            q_vec = await asyncio.to_thread(self.docs_cache.embed, user_query)
+            cached_docs = self.docs_cache.lookup(q_vec)
+            if cached_docs is not None:
+                return cached_docs ## served from the cache, no subqueries generated this turn
+
+        ## per-call locals -> a shared instance only ever fuses the current turn's rankings
+        state.sub_queries, all_documents = await self.__translate_and_retrieve(user_query, memory, state)
+
+        ## bm25 + dense results already fetched for the original query join the fusion as one more ranking
+        if prefetched_docs:
+            all_documents.append(prefetched_docs)
+
+        rrf = RRF(all_documents)
         best_docs = rrf.rearrange(top_k=self.top_k)
+
+        if q_vec is not None:
+            self.docs_cache.add(q_vec, best_docs)
         return best_docs
 
+    def invoke(self, user_query: str, memory: ConversationSummaryMemory, state: Optional[MultiQueryState] = None) -> List[Document]:
+        return asyncio.run(self.ainvoke(user_query=user_query, memory=memory, state=state))
+
 ##--------------------- test the module -------------------------------
 if __name__ == "__main__":
     from langchain_core.messages import HumanMessage, AIMessage
@@ -77,7 +193,7 @@ if __name__ == "__main__":
     from modules.preprocess_documents import load_chunk_store
     from modules.bm25_retriever import instantiate_bm25retriever
     from modules.semantic_retriever import SemanticRetriever
-    from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+    from modules.onnx_embeddings import OnnxEmbeddings, ONNX_MODEL_PATH
 
     ## setup PATH
     INPUT_DATA_PATH = "./data/raw"
@@ -124,7 +240,12 @@ if __name__ == "__main__":
     preprocessed_docs = load_chunk_store(data_path=INPUT_DATA_PATH)
     sparse_retriever = instantiate_bm25retriever(documents=preprocessed_docs)
 
-    embedF = HuggingFaceEmbeddings(model_name="all-MiniLM-L6-v2")
+    ## int8 ONNX encoder once exported with `scripts/export_quantize_minilm.py`, PyTorch otherwise
+    if os.path.exists(ONNX_MODEL_PATH):
+        embedF = OnnxEmbeddings(model_path=ONNX_MODEL_PATH)
+    else:
+        from modules.embeddings import get_embedder
+        embedF = get_embedder()
     dense_retriever = SemanticRetriever(
         embedding_function=embedF,
         prepped_docs=preprocessed_docs,
@@ -133,8 +254,9 @@ if __name__ == "__main__":
 
     ## multiquery
     mq = MultiQueryRetriever(model=llm, top_k=5, bm25_retriever=sparse_retriever, semantic_retriever=dense_retriever)
-    print(f"> Best Docs:\n\n{mq.invoke(user_query=latest_user_query, memory= memory)}\n\n\n")
-    print(f"> Subqueries: \n\n{mq.sub_queries}")
+    mq_state = mq.new_state()
+    print(f"> Best Docs:\n\n{mq.invoke(user_query=latest_user_query, memory= memory, state=mq_state)}\n\n\n")
+    print(f"> Subqueries: \n\n{mq_state.sub_queries}")
 
     # """
     # (rag-based-legal-assistant) C:\Users\sodey\Downloads\_projects\RAG-based-Legal-Assistant>uv run -m modules.multi_query_retriever
@@ -0,0 +1,75 @@
+## import dependencies
+import numpy as np
+import onnxruntime as ort
+from typing import List
+from langchain_core.embeddings import Embeddings
+from transformers import AutoTokenizer
+
+## setup PATH
+ONNX_MODEL_PATH = "./data/onnx/minilm-int8.onnx"
+
+class OnnxEmbeddings(Embeddings):
+    """
+    MiniLM sentence embeddings served by ONNX Runtime:
+    -> load the int8 model exported by `scripts/export_quantize_minilm.py`
+    -> tokenize with the original HuggingFace tokenizer, one session.run per batch
+    -> mean pooling + L2 normalization, same output as the sentence-transformers pipeline
+    """
+    def __init__(
+            self,
+            model_path: str = ONNX_MODEL_PATH,
+            model_name: str = "sentence-transformers/all-MiniLM-L6-v2",
+            batch_size: int = 32,
+            max_length: int = 256
+    ) -> None:
+        self.model_name = model_name
+        self.batch_size = batch_size
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+    def __encode(self, texts: List[str]) -> np.ndarray:
+        vectors = []
+        for start in range(0, len(texts), self.batch_size):
+            batch = self.tokenizer(
+                texts[start:start + self.batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="np"
+            )
+            feeds = {name: batch[name].astype(np.int64) for name in self.input_names}
+            hidden = self.session.run(["last_hidden_state"], feeds)[0]
+
+            ## mean pooling over the real (non padded) tokens
+            mask = batch["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            vectors.append(pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None))
+        return np.vstack(vectors) if vectors else np.empty((0, 0), dtype=np.float32)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.__encode([text])[0].tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.__encode(texts).tolist()
+
+## ---- TEST ----
+if __name__=="__main__":
+    import time
+    from modules.embeddings import get_embedder
+
+    torch_encoder = get_embedder()
+    onnx_encoder = OnnxEmbeddings()
+
+    user_query = "What punishment applies for selling a minor for the purpose of prostitution?"
+
+    start = time.perf_counter()
+    torch_vec = np.asarray(torch_encoder.embed_query(user_query))
+    print(f"> PyTorch FP32: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    start = time.perf_counter()
+    onnx_vec = np.asarray(onnx_encoder.embed_query(user_query))
+    print(f"> ONNX int8: {(time.perf_counter() - start) * 1000:.2f} ms")
+
+    print(f"> Cosine(fp32, int8): {float(torch_vec @ onnx_vec):.4f}")
@@ -1,11 +1,151 @@
 ## import dependencies
 import os
+import re
+import hashlib
+import pickle
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters.character import RecursiveCharacterTextSplitter
 from langchain.schema import Document
-from typing import List
+from typing import Iterator, List, Optional
 
-def load_chunk_store(data_path: str) -> List[Document]:
+## setup PATH
+CHUNK_CACHE_PATH = "./data/cache"
+
+## clause splitter sizes (characters) -> part of the chunk cache key, a change re-chunks the corpus
+MAX_SECTION_SIZE = 1500
+MIN_SECTION_SIZE = 200
+
+## statute structure: a line opening a section ("12.", "12A.", "65.(1)", "60.Whoever"), a chapter or a "SECTION n" heading
+_SECTION_RE = re.compile(r"(?m)^(?=[ \t]*(?:\d+[A-Z]?\.(?:\s|[A-Z(])|CHAPTER\s+[IVXLC]+\b|SECTION\s+\d+\b))")
+_SECTION_ID_RE = re.compile(r"[ \t]*(?:(\d+[A-Z]?)\.|CHAPTER\s+([IVXLC]+)\b|SECTION\s+(\d+)\b)")
+
+class ClauseAwareSplitter:
+    """
+    Section-aware splitter for legal PDFs:
+    -> every page is cut at section / chapter markers first, so a chunk never starts mid-clause
+    -> consecutive short sections are merged up to `max_section_size` characters
+    -> a block below `min_section_size` (a bare heading like "193.") is never emitted on its own, it joins the block after it
+    -> a section longer than `max_section_size` falls back to a recursive split on paragraphs, sentences, clauses, then words;
+       a fallback piece below `min_section_size` is merged into the piece after it (the last one into the piece before)
+    -> each chunk keeps the page metadata plus `section_id` of the section it starts with (when it starts with one),
+       fallback sub-chunks inherit the `section_id` of their parent section
+    """
+    def __init__(self, chunk_size: int = 1000, chunk_overlap: int = 200, max_section_size: int = MAX_SECTION_SIZE, min_section_size: int = MIN_SECTION_SIZE) -> None:
+        self.max_section_size = max_section_size
+        self.min_section_size = min_section_size
+        self.fallback = RecursiveCharacterTextSplitter(
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            separators=["\n\n", ". ", ";", " ", ""],
+            keep_separator="end" ## the full stop / semicolon stays with the clause it closes
+        )
+
+    @staticmethod
+    def __section_id(block: str) -> Optional[str]:
+        match = _SECTION_ID_RE.match(block)
+        return next((group for group in match.groups() if group), None) if match else None
+
+    @classmethod
+    def __to_document(cls, text: str, metadata: dict) -> Document:
+        section_id = cls.__section_id(text)
+        return Document(page_content=text.strip(), metadata={**metadata, "section_id": section_id} if section_id else dict(metadata))
+
+    def __merge_short(self, pieces: List[Document]) -> List[Document]:
+        ## a short piece is carried into the next one -> the merged chunk keeps the metadata (section_id) of the piece it starts with
+        merged, carry = [], None
+        for piece in pieces:
+            if carry is not None:
+                piece = Document(page_content=f"{carry.page_content}\n{piece.page_content}", metadata=carry.metadata)
+                carry = None
+            if len(piece.page_content) < self.min_section_size:
+                carry = piece
+                continue
+            merged.append(piece)
+        if carry is not None:
+            if merged:
+                merged[-1] = Document(page_content=f"{merged[-1].page_content}\n{carry.page_content}", metadata=merged[-1].metadata)
+            else:
+                merged.append(carry)
+        return merged
+
+    def split_documents(self, documents: List[Document]) -> List[Document]:
+        chunks = []
+        for doc in documents:
+            pieces, buffer = [], ""
+            for block in _SECTION_RE.split(doc.page_content):
+                if not block.strip():
+                    continue
+                ## flush the merged sections once the next one would overflow the chunk
+                ## (a buffer below min_section_size, e.g. a bare heading, always stays with the block after it)
+                if len(buffer.strip()) >= self.min_section_size and len(buffer) + len(block) > self.max_section_size:
+                    pieces.append(self.__to_document(buffer, doc.metadata))
+                    buffer = ""
+                buffer += block
+                if len(buffer) > self.max_section_size:
+                    pieces.extend(self.fallback.split_documents([self.__to_document(buffer, doc.metadata)]))
+                    buffer = ""
+            if buffer.strip():
+                pieces.append(self.__to_document(buffer, doc.metadata))
+            chunks.extend(self.__merge_short(pieces))
+        return chunks
+
+def _make_splitter(splitter: str, chunk_size: int, chunk_overlap: int):
+    assert splitter in ("clause", "recursive"), f"[ALERT] UNSUPPORTED SPLITTER: {splitter}"
+    if splitter == "clause":
+        return ClauseAwareSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+## stream the chunks of one PDF page by page -> only the current page + its chunks are held in memory
+def _iter_pdf_chunks(pdf_path: str, splitter) -> Iterator[Document]:
+    loader = PyPDFLoader(file_path=pdf_path, extract_images=False)
+    for page in loader.lazy_load(): ## `Document` per page. Each such object has - 1. Page Content // 2. Metadata
+        yield from splitter.split_documents(documents=[page])
+
+## lazily chunk every PDF in `data_path`, same chunks (and order) as load_chunk_store without the cache
+def iter_chunks(data_path: str, chunk_size: int = 1000, chunk_overlap: int = 200, splitter: str = "clause") -> Iterator[Document]:
+    text_splitter = _make_splitter(splitter, chunk_size, chunk_overlap)
+    for pdf in os.listdir(data_path):
+        if pdf.endswith(".pdf"):
+            yield from _iter_pdf_chunks(os.path.join(data_path, pdf), text_splitter)
+
+## load + chunk a single PDF -> module level so worker processes can pickle it
+def _load_and_split(pdf_path: str, chunk_size: int = 1000, chunk_overlap: int = 200, splitter: str = "clause") -> List[Document]:
+    ## pages are split independently either way -> materializing the stream gives the same chunks as loader.load()
+    return list(_iter_pdf_chunks(pdf_path, _make_splitter(splitter, chunk_size, chunk_overlap)))
+
+## fingerprint of the raw PDFs + chunking settings -> any added/removed/edited file gives a new key
+def _corpus_key(pdfs: List[str], chunk_size: int, chunk_overlap: int, splitter: str) -> str:
+    settings = f"{chunk_size}:{chunk_overlap}:{splitter}"
+    if splitter == "clause":
+        settings += f":{MAX_SECTION_SIZE}:{MIN_SECTION_SIZE}"
+    digest = hashlib.sha256(settings.encode("utf-8"))
+    for pdf in sorted(pdfs):
+        digest.update(os.path.basename(pdf).encode("utf-8"))
+        with open(pdf, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()[:16]
+
+## OS level thread count (torch / OpenMP pools are native threads `threading` doesn't see)
+def _os_thread_count() -> int:
+    try:
+        return len(os.listdir("/proc/self/task"))
+    except OSError:
+        return threading.active_count()
+
+def load_chunk_store(
+        data_path: str,
+        chunk_size: int = 1000,
+        chunk_overlap: int = 200,
+        max_workers: int = None,
+        cache_dir: Optional[str] = CHUNK_CACHE_PATH,
+        splitter: str = "clause" ## "clause" (section-aware, for statutes) or "recursive" (plain character splitting)
+) -> List[Document]:
     if not os.path.exists(data_path):
         raise FileNotFoundError(
             f"[ALERT] {data_path} doesn't exist. ⚠️⚠️"
@@ -17,21 +157,38 @@ def load_chunk_store(data_path: str) -> List[Document]:
         )
     
     ## list of all the PDFs
-    pdfs = [pdf for pdf in os.listdir(data_path) if pdf.endswith(".pdf")] ## list of all file names as str that ends with `.pdf`
+    pdfs = [os.path.join(data_path, pdf) for pdf in os.listdir(data_path) if pdf.endswith(".pdf")] ## full paths of all files that end with `.pdf`
+
+    ## same PDFs + settings as a previous run -> reuse the pickled chunks instead of parsing again
+    cache_file = None
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, f"chunks_{_corpus_key(pdfs, chunk_size=chunk_size, chunk_overlap=chunk_overlap, splitter=splitter)}.pkl")
+        if os.path.exists(cache_file):
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+
+    load_and_split = partial(_load_and_split, chunk_size=chunk_size, chunk_overlap=chunk_overlap, splitter=splitter)
 
-    doc_container = [] ## list of all chunked documents
+    ## parsing + splitting is CPU bound and independent per PDF -> one worker process per file, results keep the `pdfs` order
+    ## only `fork`: spawn / forkserver workers re-import the caller's __main__ (app.py runs its whole chat loop at module level)
+    ## only from a single-threaded process: a fork taken while other threads hold locks can deadlock the children
+    ## -> callers chunk before importing modules.language_model (torch, warm-up pass, http clients), otherwise parse serially
+    can_fork = "fork" in multiprocessing.get_all_start_methods() and _os_thread_count() == 1
+    if len(pdfs) <= 1 or not can_fork:
+        chunks = [load_and_split(pdf) for pdf in pdfs]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=min(len(pdfs), max_workers or os.cpu_count() or 1),
+            mp_context=multiprocessing.get_context("fork")
+        ) as executor:
+            chunks = list(executor.map(load_and_split, pdfs))
 
-    ## take each item from `pdfs` and load it using PyPDFLoader
-    for pdf in pdfs:
-        loader = PyPDFLoader(file_path=os.path.join(data_path, pdf),
-                                extract_images=False)
-        docs_raw = loader.load() ## list of `Document` objects loaded page wise per PDF. Each such object has - 1. Page Content // 2. Metadata
-        for doc in docs_raw:
-            doc_container.append(doc) ## append each `Document` object to the previously declared container
+    prepped_docs = list(chain.from_iterable(chunks))
 
-    ## split the documents into chunks
-    splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    prepped_docs = splitter.split_documents(documents=doc_container)
+    if cache_file:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file, "wb") as f:
+            pickle.dump(prepped_docs, f, protocol=pickle.HIGHEST_PROTOCOL)
     return prepped_docs
 
 ## ---- TEST ----
@@ -0,0 +1,8 @@
+## import dependencies
+from functools import lru_cache
+from pathlib import Path
+
+## read every prompt file at most once per process -> repeated imports/instantiations share the same string
+@lru_cache(maxsize=32)
+def load_prompt(path: str) -> str:
+    return Path(path).read_text(encoding="utf-8")
@@ -0,0 +1,43 @@
+## import dependencies
+import time
+import asyncio
+from collections import deque
+
+class RateLimiter:
+    """
+    Sliding-window rate limiter for asyncio callers:
+    -> at most `max_calls` acquisitions inside any `period`-second window
+    -> `await limiter.acquire()` returns immediately while the window has room, otherwise it sleeps only
+       until the oldest call leaves the window (instead of a fixed sleep after every call)
+    """
+    def __init__(self, max_calls: int, period: float = 60.0) -> None:
+        assert max_calls > 0, "[ALERT] max_calls MUST BE POSITIVE"
+        self.max_calls = max_calls
+        self.period = period
+        self._calls: deque = deque() ## monotonic timestamps of the calls inside the current window
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock: ## callers are released one at a time, in arrival order
+            while True:
+                now = time.monotonic()
+                while self._calls and now - self._calls[0] >= self.period:
+                    self._calls.popleft()
+                if len(self._calls) < self.max_calls:
+                    self._calls.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self._calls[0]))
+
+## ---- TEST ----
+if __name__=="__main__":
+    async def main():
+        limiter = RateLimiter(max_calls=3, period=2.0)
+        start = time.monotonic()
+
+        async def call(i):
+            await limiter.acquire()
+            print(f"> call {i} at {time.monotonic() - start:.2f}s")
+
+        await asyncio.gather(*(call(i) for i in range(7)))
+
+    asyncio.run(main())
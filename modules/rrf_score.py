@@ -1,26 +1,37 @@
+import heapq
+import numpy as np
+from collections import defaultdict
+from operator import itemgetter
 from typing import List
 from langchain.schema import Document
 
+## 1/(60+rank) precomputed for rank = 1..MAX_RANK, deeper ranks fall back to the formula
+RRF_K = 60
+MAX_RANK = 256
+RRF_WEIGHTS = 1.0 / (RRF_K + np.arange(1, MAX_RANK + 1, dtype=np.float64))
+## plain python floats for the scoring loop -> no numpy scalar boxing per (query, rank)
+_RRF_WEIGHT_LIST = RRF_WEIGHTS.tolist()
+
 class RRF:
     def __init__(self, documents: List[List[Document]]) -> None:
         self.documents = documents
-        self.rrf_scores = dict()
+        self.rrf_scores = defaultdict(float)
 
     def rearrange(self, top_k: int = 0) -> List[Document]:
         doc_map = dict()
+        scores = self.rrf_scores
         for docs in self.documents:
             for rank, doc in enumerate(docs, start=1):
-                ## making langchain.Schema.Document hashable
-                key = (doc.page_content, tuple(doc.metadata.items()))
-                doc_map[key] = doc
-
-                rrf_rank = 1/(60+rank)
-                self.rrf_scores[key] = self.rrf_scores.get(key, 0) + rrf_rank
-        
-        self.rrf_scores = sorted(self.rrf_scores.items(), key=(lambda x: x[1]), reverse=True)
-        best_docs = [doc_map[key] for key, _ in self.rrf_scores]
+                ## page_content alone identifies a chunk within one retrieval batch -> no metadata tuple per rank
+                ## str caches its hash and the retrievers hand out the same docstore strings, so repeats cost an identity check
+                key = doc.page_content
+                if key not in doc_map:
+                    doc_map[key] = doc
+                scores[key] += _RRF_WEIGHT_LIST[rank - 1] if rank <= MAX_RANK else 1 / (RRF_K + rank)
 
-        return best_docs[:top_k] if top_k else best_docs
+        ## partial selection instead of a full sort, ties keep first-seen order like sorted()
+        best = heapq.nlargest(top_k or len(self.rrf_scores), self.rrf_scores.items(), key=itemgetter(1))
+        return [doc_map[key] for key, _ in best]
     
 ## just for testing the module
 if __name__=="__main__":
@@ -0,0 +1,157 @@
+## import dependencies
+import re
+import time
+import threading
+import faiss
+import numpy as np
+from collections import OrderedDict
+from typing import Any, FrozenSet, Optional, Tuple
+
+## words pointing back into the conversation ("punishment for it?", "the above section", "tell me more")
+_CONTEXT_REFERENCE_RE = re.compile(
+    r"\b(?:it|its|this|that|these|those|they|them|their|he|she|him|her|his|above|same|previous|earlier|former|latter|more|else|again)\b",
+    re.IGNORECASE
+)
+
+## a query is only safe to answer from a query-keyed cache when it can be understood without the chat history
+## (conservative: a relative "that" also counts as a reference -> such a query is simply not cached)
+def is_context_free(user_query: str) -> bool:
+    return _CONTEXT_REFERENCE_RE.search(user_query) is None
+
+class SemanticCache:
+    """
+    Semantic Cache for chatbot responses:
+    -> create an instance with the embedding function already loaded for the retrievers
+    -> embed the user query once with .embed(user_query)
+    -> .lookup(query_vector) returns the cached response of a previous query with cosine similarity >= threshold, else None
+    -> .add(query_vector, response) stores the response generated on a cache miss (any object, e.g. retrieved documents)
+    -> least recently used entries are evicted past `max_size`, entries older than `ttl` seconds expire
+    """
+    def __init__(
+            self,
+            embedding_function,
+            threshold: float = 0.9,
+            max_size: int = 1000,
+            ttl: float = 300,
+            dim: int = 384
+    ) -> None:
+        self.embedding_function = embedding_function
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+
+        ## inner product over L2-normalized vectors == cosine similarity, IDMap2 lets us drop evicted entries
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dim))
+        self.entries: "OrderedDict[int, Tuple[Any, float]]" = OrderedDict() ## id -> (response, insertion timestamp), oldest access first
+        self._next_id = 0
+        self._lock = threading.RLock() ## lookups/adds may come from retriever worker threads
+
+    def embed(self, user_query: str) -> np.ndarray:
+        q_vec = np.asarray(self.embedding_function.embed_query(user_query), dtype=np.float32)
+        return q_vec / (np.linalg.norm(q_vec) or 1.0)
+
+    def __remove(self, ids) -> None:
+        for entry_id in ids:
+            del self.entries[entry_id]
+        self.index.remove_ids(np.asarray(ids, dtype=np.int64))
+
+    def __purge_expired(self) -> None:
+        now = time.monotonic()
+        expired = [entry_id for entry_id, (_, created) in self.entries.items() if now - created > self.ttl]
+        if expired:
+            self.__remove(expired)
+
+    def lookup(self, q_vec: np.ndarray) -> Optional[Any]:
+        with self._lock:
+            self.__purge_expired()
+            if not self.entries:
+                return None
+
+            D, I = self.index.search(q_vec[None], 1)
+            if I[0, 0] == -1 or D[0, 0] < self.threshold:
+                return None
+
+            ## cache hit -> mark as most recently used
+            entry_id = int(I[0, 0])
+            self.entries.move_to_end(entry_id)
+            return self.entries[entry_id][0]
+
+    def add(self, q_vec: np.ndarray, response: Any) -> None:
+        with self._lock:
+            if len(self.entries) >= self.max_size:
+                self.__remove([next(iter(self.entries))]) ## evict the least recently used entry
+
+            entry_id = self._next_id
+            self._next_id += 1
+            self.index.add_with_ids(q_vec[None], np.asarray([entry_id], dtype=np.int64))
+            self.entries[entry_id] = (response, time.monotonic())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+class GroundedCache:
+    """
+    Answer cache that also checks the evidence:
+    -> a cached answer is reused only if the query is close (cosine >= threshold, via SemanticCache)
+       AND the chunks retrieved now overlap the cached answer's chunks (Jaccard >= min_evidence_overlap)
+    -> paraphrased questions over the same evidence skip the llm call, a paraphrase that retrieves different chunks does not
+    -> chunks are identified by hash(page_content), the cache lives in memory for one process only
+    """
+    def __init__(
+            self,
+            embedding_function,
+            threshold: float = 0.92,
+            min_evidence_overlap: float = 0.7,
+            max_size: int = 1000,
+            ttl: float = 24 * 3600,
+            dim: int = 384
+    ) -> None:
+        self.min_evidence_overlap = min_evidence_overlap
+        self.cache = SemanticCache(
+            embedding_function=embedding_function,
+            threshold=threshold,
+            max_size=max_size,
+            ttl=ttl,
+            dim=dim
+        )
+
+    def embed(self, user_query: str) -> np.ndarray:
+        return self.cache.embed(user_query)
+
+    @staticmethod
+    def evidence_ids(documents) -> FrozenSet[int]:
+        return frozenset(hash(doc.page_content) for doc in documents)
+
+    @staticmethod
+    def __jaccard(a: FrozenSet[int], b: FrozenSet[int]) -> float:
+        ## no evidence on either side -> nothing grounds the answer, never a hit
+        return len(a & b) / len(a | b) if a and b else 0.0
+
+    def lookup(self, q_vec: np.ndarray, evidence: FrozenSet[int]) -> Optional[str]:
+        cached = self.cache.lookup(q_vec)
+        if cached is None:
+            return None
+        cached_evidence, answer = cached
+        return answer if self.__jaccard(evidence, cached_evidence) >= self.min_evidence_overlap else None
+
+    def add(self, q_vec: np.ndarray, evidence: FrozenSet[int], answer: str) -> None:
+        self.cache.add(q_vec, (evidence, answer))
+
+    def __len__(self) -> int:
+        return len(self.cache)
+
+## ---- TEST ----
+if __name__=="__main__":
+    from modules.embeddings import get_embedder
+
+    embedF = get_embedder()
+    cache = SemanticCache(embedding_function=embedF, max_size=2, ttl=300)
+
+    first_query = cache.embed("What is the minimum age for marriage under the Special Marriage Act?")
+    cache.add(first_query, "The male must be 21 and the female 18 years of age.")
+
+    paraphrased_query = cache.embed("Under the Special Marriage Act, what's the minimum marriage age?")
+    unrelated_query = cache.embed("Who can grant a patent in India?")
+
+    print(f"> Paraphrase: {cache.lookup(paraphrased_query)}")
+    print(f"> Unrelated: {cache.lookup(unrelated_query)}")
@@ -1,54 +1,321 @@
 ## langchain dependencies
-from langchain_huggingface import HuggingFaceEmbeddings
+from langchain_core.embeddings import Embeddings
 from langchain_community.vectorstores import FAISS
-from typing import List
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.callbacks import AsyncCallbackManagerForRetrieverRun, CallbackManagerForRetrieverRun
+from langchain_core.vectorstores import VectorStoreRetriever
+from typing import List, Optional, Tuple
 from langchain.schema import Document
+import asyncio
+import faiss
+import hashlib
+import pickle
+import numpy as np
+from modules.semantic_cache import SemanticCache
 
 ## settings up the env
 import os
 from dotenv import load_dotenv
 load_dotenv()
 
+class CachedVectorStoreRetriever(VectorStoreRetriever):
+    """
+    VectorStoreRetriever with a similarity-keyed result cache:
+    -> the query is embedded (memoized by the embedding wrapper), its L2-normalized vector is looked up in `result_cache`
+    -> hit (cosine >= the cache threshold) -> previous documents are returned, no FAISS search at all
+    -> miss -> plain similarity search by vector, result stored for the next near-identical query
+    -> retrieve_many(queries) embeds the whole batch in one model call and searches all cache misses in one FAISS call
+    """
+    result_cache: Optional[SemanticCache] = None
+
+    @staticmethod
+    def __cache_vector(q_vec: List[float]) -> np.ndarray:
+        cache_vec = np.asarray(q_vec, dtype=np.float32)
+        cache_vec /= (np.linalg.norm(cache_vec) or 1.0)
+        return cache_vec
+
+    def __search(self, query: str) -> List[Document]:
+        q_vec = self.vectorstore.embeddings.embed_query(query)
+        cache_vec = self.__cache_vector(q_vec)
+
+        cached = self.result_cache.lookup(cache_vec)
+        if cached is not None:
+            return list(cached)
+
+        docs = self.vectorstore.similarity_search_by_vector(q_vec, **self.search_kwargs)
+        self.result_cache.add(cache_vec, docs)
+        return docs
+
+    def retrieve_many(self, queries: List[str]) -> List[List[Document]]:
+        if self.result_cache is None or self.search_type != "similarity":
+            return [self.invoke(query) for query in queries]
+
+        ## batch-embed first -> the embed_query calls below are cache hits (CachedEmbeddings), one model call for the misses
+        embeddings = self.vectorstore.embeddings
+        if hasattr(embeddings, "prime_queries"):
+            embeddings.prime_queries(queries)
+        q_vecs = [embeddings.embed_query(query) for query in queries]
+
+        results: List[Optional[List[Document]]] = []
+        misses = []
+        for row, q_vec in enumerate(q_vecs):
+            cached = self.result_cache.lookup(self.__cache_vector(q_vec))
+            results.append(list(cached) if cached is not None else None)
+            if cached is None:
+                misses.append(row)
+
+        ## every miss searched in a single [Q, d] FAISS call
+        found = batch_similarity_search(self.vectorstore, [q_vecs[row] for row in misses], k=self.search_kwargs.get("k", 4))
+        for row, docs in zip(misses, found):
+            results[row] = docs
+            self.result_cache.add(self.__cache_vector(q_vecs[row]), docs)
+        return results
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        if self.result_cache is None or self.search_type != "similarity" or kwargs:
+            return super()._get_relevant_documents(query, run_manager=run_manager, **kwargs)
+        return self.__search(query)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun, **kwargs) -> List[Document]:
+        if self.result_cache is None or self.search_type != "similarity" or kwargs:
+            return await super()._aget_relevant_documents(query, run_manager=run_manager, **kwargs)
+        return await asyncio.to_thread(self.__search, query)
+
 class SemanticRetriever:
     """
     Semantic Retriever for FAISS:
     -> create an instance with embedding model, prepped documents and output path to save the vector store locally
-    -> access the semantic retriever by .retriever
+    -> document vectors are L2-normalized and stored in an HNSW graph (inner product == cosine), O(log n) search instead of a flat scan
+    -> index_type="flat" (or FAISS_INDEX_TYPE="flat" in .env) builds an exact IndexFlatIP instead, for accuracy A/B checks
+    -> index_type="ivfpq" builds an IVF-PQ index (8-bit codes, m sub-quantizers) for large corpora, ~8x smaller than fp32
+       (below 256 chunks the codes shrink to floor(log2(n)) bits so the codebooks can still be trained)
+    -> index_type="hnsw_sq8" keeps the HNSW graph but stores the vectors as 8-bit scalar-quantized codes, ~4x smaller than fp32
+       (type + build parameters are part of the store fingerprint -> switching them rebuilds a fingerprinted store)
+    -> the store is stamped with a fingerprint of the chunks + embedding model, a later start only re-embeds when that changed
+    -> access the semantic retriever by .retriever (near-duplicate queries are answered from a result cache)
     -> invoke by .retriever.invoke(user_query)
     """
     def __init__(
             self,
-            embedding_function: HuggingFaceEmbeddings,
+            embedding_function: Embeddings, ## HuggingFaceEmbeddings, OnnxEmbeddings, CachedEmbeddings, ...
             prepped_docs: List[Document],
-            vectordb_output_path: str
+            vectordb_output_path: str,
+            hnsw_m: int = 32,
+            ef_construction: int = 200,
+            ef_search: int = 64,
+            index_type: str = os.getenv("FAISS_INDEX_TYPE", "hnsw"),
+            result_cache_size: int = 256,
+            result_cache_threshold: float = 0.97,
+            ivf_nlist: int = 256,
+            pq_m: int = 48,
+            pq_nbits: int = 8,
+            nprobe: int = 16,
+            max_train_vectors: int = 10000,
+            embedding_batch_size: int = 256
     ) -> None:
+        assert index_type in ("hnsw", "flat", "ivfpq", "hnsw_sq8"), f"[ALERT] UNSUPPORTED FAISS INDEX TYPE: {index_type}"
         self.embedding_function = embedding_function
         self.prepped_docs = prepped_docs
         self.vectordb_output_path = os.path.abspath(vectordb_output_path)
+        self.hnsw_m = hnsw_m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.index_type = index_type
+        self.result_cache_size = result_cache_size
+        self.result_cache_threshold = result_cache_threshold
+        self.ivf_nlist = ivf_nlist
+        self.pq_m = pq_m
+        self.pq_nbits = pq_nbits
+        self.nprobe = nprobe
+        self.max_train_vectors = max_train_vectors
+        self.embedding_batch_size = embedding_batch_size
+
+    def __build_params(self) -> str:
+        ## everything that shapes the saved index, search-time knobs (ef_search, nprobe) are applied on load instead
+        if self.index_type == "hnsw":
+            return f"hnsw:{self.hnsw_m}:{self.ef_construction}"
+        if self.index_type == "hnsw_sq8":
+            return f"hnsw_sq8:{self.hnsw_m}:{self.ef_construction}:{self.max_train_vectors}"
+        if self.index_type == "ivfpq":
+            nlist, nbits = self.__ivfpq_shape(len(self.prepped_docs))
+            return f"ivfpq:{nlist}:{self.pq_m}:{nbits}:{self.max_train_vectors}"
+        return self.index_type
+
+    def __ivfpq_shape(self, n: int) -> Tuple[int, int]:
+        ## effective (nlist, nbits) for a corpus of n chunks -> small corpora get fewer lists and smaller PQ codebooks
+        ## k-means wants ~39 training points per list and needs >= 2**nbits points per sub-quantizer codebook
+        n_train = min(n, self.max_train_vectors)
+        nlist = max(1, min(self.ivf_nlist, n // 39))
+        nbits = min(self.pq_nbits, max(n_train, 1).bit_length() - 1) ## floor(log2(n_train))
+        return nlist, nbits
+
+    def __corpus_key(self) -> str:
+        model_name = getattr(self.embedding_function, "model_name", type(self.embedding_function).__name__)
+        digest = hashlib.sha256(f"{model_name}\0{self.__build_params()}".encode("utf-8"))
+        for doc in self.prepped_docs:
+            digest.update(doc.page_content.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()[:16]
+
+    def __is_stale(self, vector_db: FAISS) -> bool:
+        key_file = os.path.join(self.vectordb_output_path, "corpus_key.txt")
+        if os.path.exists(key_file):
+            with open(key_file, "r", encoding="utf-8") as f:
+                return f.read().strip() != self.__corpus_key()
+        ## stores saved before the fingerprint existed -> only the chunk count can be checked
+        return vector_db.index.ntotal != len(self.prepped_docs)
+
+    def __embed(self, texts: List[str]) -> np.ndarray:
+        vectors = np.asarray(self.embedding_function.embed_documents(texts), dtype=np.float32)
+        faiss.normalize_L2(vectors) ## unit vectors -> inner product == cosine, query norm doesn't change the ranking
+        return vectors
+
+    def __build_ivfpq(self, train_vectors: np.ndarray, n: int):
+        dim = train_vectors.shape[1]
+        nlist, nbits = self.__ivfpq_shape(n)
+        ## a single chunk can't train any codebook -> exact flat index, same cosine scores
+        if nbits < 1:
+            return faiss.IndexFlatIP(dim)
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, self.pq_m, nbits, faiss.METRIC_INNER_PRODUCT)
+        index.train(train_vectors)
+        index.nprobe = self.nprobe
+        return index
+
+    def __build_hnsw_sq8(self, train_vectors: np.ndarray):
+        ## 8-bit codes per dimension, ranges learned from the training sample -> dot products on int8 codes, graph search unchanged
+        index = faiss.IndexHNSWSQ(train_vectors.shape[1], faiss.ScalarQuantizer.QT_8bit, self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = self.ef_construction
+        index.train(train_vectors)
+        return index
 
     def __build_vectordb(self) -> None:
-        vector_db = FAISS.from_documents(documents=self.prepped_docs, embedding=self.embedding_function)
+        texts = [doc.page_content for doc in self.prepped_docs]
+        metadatas = [doc.metadata for doc in self.prepped_docs]
+
+        ## IVF-PQ codebooks / SQ8 ranges must be trained before anything is added -> embed a fixed random subset up front
+        ## (training only needs a representative sample), those vectors are reused when their batch comes up
+        sample = {}
+        if self.index_type in ("ivfpq", "hnsw_sq8"):
+            rng = np.random.default_rng(0)
+            train_ids = rng.choice(len(texts), size=min(len(texts), self.max_train_vectors), replace=False).tolist()
+            train_vectors = self.__embed([texts[i] for i in train_ids])
+            sample = dict(zip(train_ids, train_vectors))
+            if self.index_type == "ivfpq":
+                index = self.__build_ivfpq(train_vectors, n=len(texts))
+            else:
+                index = self.__build_hnsw_sq8(train_vectors)
+            del train_vectors
+
+        ## embed + add `embedding_batch_size` chunks at a time -> only one batch of fp32 vectors is alive, not the whole corpus
+        vector_db = None
+        for start in range(0, len(texts), self.embedding_batch_size):
+            batch_ids = range(start, min(start + self.embedding_batch_size, len(texts)))
+            missing = [i for i in batch_ids if i not in sample]
+            fresh = dict(zip(missing, self.__embed([texts[i] for i in missing]))) if missing else {}
+            vectors = np.stack([sample.pop(i) if i in sample else fresh[i] for i in batch_ids])
+
+            if vector_db is None:
+                if self.index_type == "flat":
+                    index = faiss.IndexFlatIP(vectors.shape[1]) ## exact search over the same cosine scores
+                elif self.index_type == "hnsw":
+                    index = faiss.IndexHNSWFlat(vectors.shape[1], self.hnsw_m, faiss.METRIC_INNER_PRODUCT)
+                    index.hnsw.efConstruction = self.ef_construction
+
+                vector_db = FAISS(
+                    embedding_function=self.embedding_function,
+                    index=index,
+                    docstore=InMemoryDocstore(),
+                    index_to_docstore_id={},
+                    distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+                )
+            vector_db.add_embeddings(
+                text_embeddings=zip(texts[start:batch_ids.stop], vectors.tolist()),
+                metadatas=metadatas[start:batch_ids.stop]
+            )
+
+        assert vector_db is not None, "[ALERT] NO DOCUMENTS TO BUILD THE VECTOR STORE FROM"
         vector_db.save_local(self.vectordb_output_path)
+        with open(os.path.join(self.vectordb_output_path, "corpus_key.txt"), "w", encoding="utf-8") as f:
+            f.write(self.__corpus_key())
+
+    def __load_vectordb(self) -> FAISS:
+        ## mmap flag -> faiss maps the index file where the index type supports it instead of copying it into RAM
+        index = faiss.read_index(os.path.join(self.vectordb_output_path, "index.faiss"), faiss.IO_FLAG_MMAP)
+        with open(os.path.join(self.vectordb_output_path, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+
+        ## search-time breadth of the HNSW graph is not persisted -> set it on every load
+        if hasattr(index, "hnsw"):
+            index.hnsw.efSearch = self.ef_search
+        ## same for the number of probed IVF lists
+        if hasattr(index, "nprobe"):
+            index.nprobe = self.nprobe
+
+        ## older flat L2 stores keep working
+        is_inner_product = index.metric_type == faiss.METRIC_INNER_PRODUCT
+        return FAISS(
+            embedding_function=self.embedding_function,
+            index=index,
+            docstore=docstore,
+            index_to_docstore_id=index_to_docstore_id,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT if is_inner_product else DistanceStrategy.EUCLIDEAN_DISTANCE
+        )
 
     @property
     def retriever(self):
-        if not os.path.exists(self.vectordb_output_path):
+        ## the index file, not the directory, decides -> a folder created by something else is not a saved store
+        if not os.path.exists(os.path.join(self.vectordb_output_path, "index.faiss")):
             self.__build_vectordb()
         ## if already exists, skip building
-        vector_db = FAISS.load_local(self.vectordb_output_path, embeddings=self.embedding_function, allow_dangerous_deserialization=True)
-        semantic_retriever = vector_db.as_retriever(search_type="similarity",search_kwargs={"k": 10})
+        vector_db = self.__load_vectordb()
+        ## store was built from different chunks (another splitter, edited PDFs) or another embedding model -> rebuild it
+        if self.__is_stale(vector_db):
+            self.__build_vectordb()
+            vector_db = self.__load_vectordb()
+        ## near-identical queries (cosine >= result_cache_threshold) reuse the previous search result
+        result_cache = SemanticCache(
+            embedding_function=self.embedding_function,
+            threshold=self.result_cache_threshold,
+            max_size=self.result_cache_size,
+            ttl=3600,
+            dim=vector_db.index.d
+        )
+        semantic_retriever = CachedVectorStoreRetriever(
+            vectorstore=vector_db,
+            search_type="similarity",
+            search_kwargs={"k": 10},
+            result_cache=result_cache
+        )
         return semantic_retriever
     
+## batched dense search: one FAISS call for a whole [Q, d] query matrix instead of Q retriever invokes
+def batch_similarity_search(vector_db: FAISS, query_vectors: List[List[float]], k: int = 10) -> List[List[Document]]:
+    if not query_vectors:
+        return []
+    _, indices = vector_db.index.search(np.asarray(query_vectors, dtype=np.float32), k)
+    return [
+        [vector_db.docstore.search(vector_db.index_to_docstore_id[i]) for i in row if i != -1] ## -1 -> fewer than k hits
+        for row in indices
+    ]
+
 ## ---- TEST ----
 if __name__=="__main__":
     from modules.preprocess_documents import load_chunk_store
+    from modules.onnx_embeddings import OnnxEmbeddings, ONNX_MODEL_PATH
     import shutil
 
     INPUT_PATH = "./data/raw"
     DUMMY_OUTPUT_PATH = "./data/vectors/dummy"
 
     preprocessed_docs = load_chunk_store(data_path=INPUT_PATH)
-    embedF = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+    ## int8 ONNX encoder once exported with `scripts/export_quantize_minilm.py`, PyTorch otherwise
+    if os.path.exists(ONNX_MODEL_PATH):
+        embedF = OnnxEmbeddings(model_path=ONNX_MODEL_PATH)
+    else:
+        from modules.embeddings import get_embedder
+        embedF = get_embedder()
 
     dense_retriever = SemanticRetriever(
         embedding_function=embedF,
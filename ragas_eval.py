@@ -1,18 +1,27 @@
 ## import dependencies
-import time
+import os
+import json
+import asyncio
+import logging
+import logging.handlers
 import pandas as pd
-from modules.language_model import llm, embedF
+from dataclasses import dataclass
 from langchain_core.messages import AIMessage, HumanMessage
 from modules.conversation_history import ConversationSummaryMemory
 from modules.preprocess_documents import load_chunk_store
-from modules.decide_query_complexity import QueryComplexity
+from modules.decide_query_complexity import QueryComplexity, CachedComplexity
 from modules.chatbot_response import ChatbotResponse
 from modules.bm25_retriever import instantiate_bm25retriever
 from modules.semantic_retriever import SemanticRetriever
 from modules.multi_query_retriever import MultiQueryRetriever
 from modules.multi_hop_retriever import MultiHopRetriever
-from typing import List
+from modules.prompts import load_prompt
+from modules.rate_limiter import RateLimiter
+from modules.semantic_cache import GroundedCache
+from typing import Dict, List, Tuple
 from langchain.schema import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.embeddings import Embeddings
 
 ## supress langchain warning
 import warnings
@@ -23,56 +32,79 @@ warnings.filterwarnings("ignore", category=LangChainBetaWarning)
 INPUT_DATA_PATH = "./data"
 OUTPUT_DATA_PATH = "./data-ingestion-local"
 RAGAS_DATASET_PATH = "./RAGAS-dataset/eval-dataset.csv"
+PARTIAL_RESULTS_PATH = "./RAGAS-dataset/eval-partial.jsonl"
+FINAL_RESULTS_PATH = "./RAGAS-dataset/eval-dataset-final.parquet"
+FINAL_RESULTS_CSV_PATH = "./RAGAS-dataset/eval-dataset-final.csv"
+## eval-only caches live next to the vector store, not inside it (the FAISS store owns OUTPUT_DATA_PATH)
+EVAL_CACHE_PATH = "./data-eval-cache"
+COMPLEXITY_CACHE_PATH = os.path.join(EVAL_CACHE_PATH, "complexity_cache.pkl")
+BM25_INDEX_PATH = os.path.join(EVAL_CACHE_PATH, "bm25") ## own index -> app.py and the eval don't rebuild each other's
 
-## main RAG prompt template
-with open("./prompts/mainRAG-prompt.md") as f:
-    rag_prompt_template = f.read()
-
-## RAGAS evaluation dataset
-eval_df = pd.read_csv(RAGAS_DATASET_PATH)
+## rate budget for the evaluation run -> a row issues several llm calls (complexity, retrieval, response)
+## RAGAS_ROWS_PER_MINUTE=0 lifts the budget (paid keys), rows are then only bounded by the concurrency
+ROWS_PER_MINUTE = int(os.getenv("RAGAS_ROWS_PER_MINUTE", "3"))
+MAX_CONCURRENT_ROWS = int(os.getenv("RAGAS_MAX_CONCURRENT_ROWS", "8"))
 
-## to store responses for evaluation
-answers: List[str] = []
-retrieved_documents: List[List[str]] = []
+## main RAG prompt template
+rag_prompt_template = load_prompt("./prompts/mainRAG-prompt.md")
 
-## chatbot response generator
-response_generator = ChatbotResponse(model=llm, rag_prompt_template=rag_prompt_template)
+## per-row progress log -> buffered, written to stderr in batches of 32 records (and on anything >= WARNING)
+log = logging.getLogger("ragas_eval")
+log.setLevel(logging.INFO)
+log.addHandler(logging.handlers.MemoryHandler(capacity=32, flushLevel=logging.WARNING, target=logging.StreamHandler()))
+log.propagate = False
 
-## query complexity decider
-complexity_decider = QueryComplexity(model=llm)
+## ---- EVALUATION CONTEXT ----
+@dataclass
+class EvalContext:
+    """
+    Everything a row needs, built once by build_context():
+    -> importing this module stays cheap (no corpus loading / index building), the run itself is behind `__main__`
+    -> shared by every concurrent row, none of the members keeps per-row state
+    """
+    response_generator: ChatbotResponse
+    cheap_response_generator: ChatbotResponse
+    complexity_decider: CachedComplexity
+    sparse_retriever: BaseRetriever
+    dense_retriever: BaseRetriever
+    multiquery_retriever: MultiQueryRetriever
+    multihop_retriever: MultiHopRetriever
+    answer_cache: GroundedCache
+    memory_template: ConversationSummaryMemory
+    embedding_function: Embeddings
 
-## process documents
-preprocessed_docs = load_chunk_store(data_path=INPUT_DATA_PATH)
+def build_context() -> EvalContext:
+    ## process documents first -> load_chunk_store forks its PDF workers while the process is still single-threaded
+    preprocessed_docs = load_chunk_store(data_path=INPUT_DATA_PATH)
 
-## set up retrievers - bm25, semantic
-sparse_retriever = instantiate_bm25retriever(documents=preprocessed_docs)
+    ## models only afterwards: modules.language_model starts the torch / OpenMP threads with its warm-up pass on import
+    from modules.language_model import llm, cheap_llm, embedF
 
-dense_retriever = SemanticRetriever(
-    embedding_function=embedF,
-    prepped_docs=preprocessed_docs,
-    vectordb_output_path=OUTPUT_DATA_PATH
-).retriever
+    ## chatbot response generator
+    response_generator = ChatbotResponse(model=llm, rag_prompt_template=rag_prompt_template)
+    ## simple conversation rows retrieve nothing -> answered by the smaller model
+    cheap_response_generator = ChatbotResponse(model=cheap_llm, rag_prompt_template=rag_prompt_template)
 
-count = 0
-## ---- GENERATE ANSWER IN A LOOP FOR THE EVALUATION DATASET ----
-for index, row in eval_df.iterrows():
-    retrieved_docs: List[Document] = []
-    subquery_plus_docs = ""
-
-    ## conversation history
-    chat_history = ConversationSummaryMemory(model=llm, k=3)
-    chat_history.append(AIMessage(content="Hello! I'm a RAG-based legal assistant. How may I help you today?"))
+    ## query complexity decider -> every row starts from the same memory, so a decision only depends on the question
+    ## identical / paraphrased questions reuse it, also across evaluation runs
+    complexity_decider = CachedComplexity(
+        complexity_decider=QueryComplexity(model=llm),
+        embedding_function=embedF,
+        threshold=0.95,
+        cache_path=COMPLEXITY_CACHE_PATH
+    )
 
-    ## pick the question from the dataset
-    ragas_question = row["question"]
+    ## set up retrievers - bm25, semantic
+    ## both are persisted (EVAL_CACHE_PATH / OUTPUT_DATA_PATH) -> later runs memory-map them instead of re-tokenizing / re-embedding the corpus
+    sparse_retriever = instantiate_bm25retriever(documents=preprocessed_docs, index_path=BM25_INDEX_PATH)
 
-    ## fetch the complexity tier
-    complexity_tier = complexity_decider.invoke(
-        user_query=ragas_question,
-        memory=chat_history
-    )
+    dense_retriever = SemanticRetriever(
+        embedding_function=embedF,
+        prepped_docs=preprocessed_docs,
+        vectordb_output_path=OUTPUT_DATA_PATH
+    ).retriever
 
-    ## set up both the retrievers multi-query and multi-hop
+    ## multi-query + multi-hop retrievers keep no per-row state (locals / HopState) -> one shared instance each for every row
     multiquery_retriever = MultiQueryRetriever(
         model=llm,
         bm25_retriever=sparse_retriever,
@@ -85,47 +117,166 @@ for index, row in eval_df.iterrows():
         semantic_retriever=dense_retriever
     )
 
+    ## paraphrased questions answered from (nearly) the same chunks reuse the earlier answer instead of another llm call
+    answer_cache = GroundedCache(embedding_function=embedF, threshold=0.92, min_evidence_overlap=0.7, dim=dense_retriever.vectorstore.index.d)
+
+    ## every row starts from the same greeting -> built once, forked per row
+    memory_template = ConversationSummaryMemory(model=llm, k=3)
+    memory_template.append(AIMessage(content="Hello! I'm a RAG-based legal assistant. How may I help you today?"))
+
+    return EvalContext(
+        response_generator=response_generator,
+        cheap_response_generator=cheap_response_generator,
+        complexity_decider=complexity_decider,
+        sparse_retriever=sparse_retriever,
+        dense_retriever=dense_retriever,
+        multiquery_retriever=multiquery_retriever,
+        multihop_retriever=multihop_retriever,
+        answer_cache=answer_cache,
+        memory_template=memory_template,
+        embedding_function=embedF
+    )
+
+## ---- ANSWER ONE ROW OF THE EVALUATION DATASET ----
+async def process_row(ctx: EvalContext, ragas_question: str):
+    retrieved_docs: List[Document] = []
+    subquery_plus_docs = ""
+
+    ## conversation history, a per-row copy of the shared greeting-only history
+    chat_history = ctx.memory_template.fork()
+
+    ## fetch the complexity tier while speculatively prefetching sparse + dense results for the raw question (same as app.py)
+    complexity_tier, prefetched_sparse, prefetched_dense = await asyncio.gather(
+        ctx.complexity_decider.ainvoke(user_query=ragas_question, memory=chat_history),
+        ctx.sparse_retriever.ainvoke(ragas_question),
+        ctx.dense_retriever.ainvoke(ragas_question)
+    )
+
     ## fetch document based on the retriever type decided from `complexity_tier`
+    ## both retrievers fire their sparse + dense searches concurrently, the prefetched results join the multi-query fusion
     if complexity_tier == "complex":
-        retrieved_docs.extend(multiquery_retriever.invoke(user_query=ragas_question, memory=chat_history))
-    elif complexity_tier == "multi-hop":
-        subquery_plus_docs += multihop_retriever.invoke(user_query=ragas_question, memory=chat_history)
+        retrieved_docs.extend(await ctx.multiquery_retriever.ainvoke(
+            user_query=ragas_question,
+            memory=chat_history,
+            prefetched_docs=prefetched_sparse + prefetched_dense
+        ))
+    elif complexity_tier == "multi_hop":
+        hop_state = ctx.multihop_retriever.new_state() ## keeps the per-hop documents (+ the near-duplicate subquery cache) for the contexts below
+        subquery_plus_docs += await ctx.multihop_retriever.ainvoke(user_query=ragas_question, memory=chat_history, state=hop_state)
 
     ## append the question in the chat memory
     chat_history.append(HumanMessage(content=ragas_question))  ## store it in the history
 
-    ## response generation
-    ai_resp = response_generator.invoke(
-        memory=chat_history,
-        subquery_docs=subquery_plus_docs,
-        documents=retrieved_docs
+    ## retrieved documents
+    evidence_docs: List[Document] = []
+    if complexity_tier == "complex":
+        ## for retrieved documents (Multi Query)
+        evidence_docs = retrieved_docs
+    elif complexity_tier == "multi_hop":
+        ## for subquery_plus_docs (Multi Hop)
+        evidence_docs = [doc for hop_docs in hop_state.retrieved for doc in hop_docs]
+    retrieved_contexts = [doc.page_content for doc in evidence_docs]
+
+    ## response generation, skipped when a close question was already answered from the same evidence
+    query_vector = await asyncio.to_thread(ctx.answer_cache.embed, ragas_question)
+    evidence = GroundedCache.evidence_ids(evidence_docs)
+    ai_resp = ctx.answer_cache.lookup(query_vector, evidence)
+    if ai_resp is None:
+        generator = ctx.cheap_response_generator if complexity_tier == "simple_conversation" else ctx.response_generator
+        ai_resp = await generator.ainvoke(
+            memory=chat_history,
+            subquery_docs=subquery_plus_docs,
+            documents=retrieved_docs
+        )
+        ctx.answer_cache.add(query_vector, evidence, ai_resp)
+
+    return ai_resp, retrieved_contexts
+
+## ---- RESUME AN INTERRUPTED RUN ----
+def load_partial_results(path: str = PARTIAL_RESULTS_PATH) -> Dict[int, Tuple[str, List[str]]]:
+    ## every finished row is one json line {"index", "response", "retrieved_contexts"}
+    completed: Dict[int, Tuple[str, List[str]]] = {}
+    if not os.path.exists(path):
+        return completed
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue ## half written line of a crashed run -> that row is answered again
+            completed[record["index"]] = (record["response"], record["retrieved_contexts"])
+    return completed
+
+## ---- GENERATE ANSWERS FOR THE EVALUATION DATASET ----
+async def main(ctx: EvalContext, eval_df: pd.DataFrame):
+    ## rows start as soon as the rate window allows instead of a fixed 60s sleep after each one
+    limiter = RateLimiter(max_calls=ROWS_PER_MINUTE, period=60) if ROWS_PER_MINUTE > 0 else None
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_ROWS)
+    completed = load_partial_results()
+    count = 0
+
+    if completed:
+        print(f"[ALERT] Resuming evaluation, {len(completed)} rows already answered in {PARTIAL_RESULTS_PATH}")
+
+    ## every row shares the greeting-only memory -> classify all unanswered questions up front, 25 per llm call
+    await ctx.complexity_decider.aprefetch(
+        [row["question"] for index, row in eval_df.iterrows() if index not in completed],
+        memory=ctx.memory_template,
+        batch_size=25
     )
 
-    ## append response to answers
-    answers.append(ai_resp)
+    async def limited_row(index: int, ragas_question: str, partial_file):
+        nonlocal count
+        if index in completed:
+            return completed[index]
 
+        async with semaphore:
+            if limiter is not None:
+                await limiter.acquire()
+            ai_resp, retrieved_contexts = await process_row(ctx, ragas_question)
 
-    ## append retriever documents
-    if complexity_tier == "complex":
-        ## for retrieved documents (Multi Query)
-        retrieved_docs_string_format: List[str] = [doc.page_content for doc in retrieved_docs]
-        retrieved_documents.append(retrieved_docs_string_format)
-    elif complexity_tier == "multi-hop":
-        ## for subquery_plus_docs (Multi Hop)
-        multihop_retrieved_docs: List[Document] = multihop_retriever.retrieved_respective_documents
-        multihop_retrieved_docs_string_format: List[str] = [doc.page_content for doc in multihop_retrieved_docs]
-        retrieved_documents.append(multihop_retrieved_docs_string_format)
+        ## persist the row right away -> a crash later in the run keeps it
+        partial_file.write(json.dumps({"index": index, "response": ai_resp, "retrieved_contexts": retrieved_contexts}, ensure_ascii=False) + "\n")
+        partial_file.flush()
+
+        ## debug procedures -> lazily formatted + truncated, long answers don't flood the console
+        count += 1
+        log.info("Q%d: %.200s -> %.200s", count, ragas_question, ai_resp)
+        return ai_resp, retrieved_contexts
+
+    ## gather keeps the dataset order, whatever order the rows finish in
+    with open(PARTIAL_RESULTS_PATH, "a+", encoding="utf-8") as partial_file:
+        ## a crashed run may have left a half written last line -> new rows start on a fresh line
+        if partial_file.tell() > 0:
+            partial_file.seek(partial_file.tell() - 1)
+            if partial_file.read(1) != "\n":
+                partial_file.write("\n")
+        return await asyncio.gather(*(limited_row(index, row["question"], partial_file) for index, row in eval_df.iterrows()))
+
+def run_eval(ctx: EvalContext) -> None:
+    ## RAGAS evaluation dataset
+    eval_df = pd.read_csv(RAGAS_DATASET_PATH)
+
+    ## embed every question up front in batches -> the per-row retrievers / caches find them in the embedding cache
+    if hasattr(ctx.embedding_function, "prime_queries"):
+        ctx.embedding_function.prime_queries([row["question"] for _, row in eval_df.iterrows()], batch_size=64)
+
+    results = asyncio.run(main(ctx, eval_df))
+    ctx.complexity_decider.save()
+
+    ## save all this to a dataframe -> parquet keeps `retrieved_contexts` as a list column (no literal_eval when scoring)
+    eval_df['response'] = [ai_resp for ai_resp, _ in results]
+    eval_df['retrieved_contexts'] = [retrieved_contexts for _, retrieved_contexts in results]
 
-    ## debug procedures
-    count += 1
-    print(f"Question {count}".center(80, "-"))
-    print(f"> Human: {ragas_question}")
-    print(f"> AI: {ai_resp}")
+    eval_df.to_parquet(FINAL_RESULTS_PATH, index=False)
 
-    time.sleep(60)
+    ## human readable copy -> contexts as json text, so scoring from the csv is a json.loads instead of literal_eval
+    eval_df.assign(
+        retrieved_contexts=[json.dumps(retrieved_contexts, ensure_ascii=False) for retrieved_contexts in eval_df['retrieved_contexts']]
+    ).to_csv(FINAL_RESULTS_CSV_PATH, index=False)
 
-## save all this to a dataframe
-eval_df['response'] = answers
-eval_df['retrieved_contexts'] = retrieved_documents
+    ## the run is complete -> the next one starts from scratch
+    os.remove(PARTIAL_RESULTS_PATH)
 
-eval_df.to_csv("./RAGAS-dataset/eval-dataset-final.csv", index=False)
\ No newline at end of file
+if __name__=="__main__":
+    run_eval(build_context())
@@ -1,20 +1,28 @@
 ## import dependencies
+import os
+import json
 from datasets import Dataset
 from ragas import evaluate
 from modules.language_model import ragas_eval_llm, ragas_eval_embedF
 from ragas.metrics import faithfulness, answer_correctness
 from ragas.run_config import RunConfig
-from ast import literal_eval
 
-## load as Dataset -> convert to pandas DataFrame
-dataset = Dataset.from_csv("RAGAS-dataset/eval-dataset-final.csv")
-df = dataset.to_pandas()
+## setup PATH
+RESULTS_PATH = "RAGAS-dataset/eval-dataset-final.parquet"
+RESULTS_CSV_PATH = "RAGAS-dataset/eval-dataset-final.csv"
 
-## apply literal eval to unwrap the lists (since it gets stored wrapped around a string while calling .to_csv())
-df['retrieved_contexts'] = df['retrieved_contexts'].apply(literal_eval)
+## metric jobs (one llm call per row and metric) run concurrently on ragas' executor
+## match it to what the judge can serve -> a local Ollama only runs them in parallel with OLLAMA_NUM_PARALLEL > 1
+SCORE_MAX_WORKERS = int(os.getenv("RAGAS_SCORE_MAX_WORKERS", "32"))
 
-## convert back to Dataset for RAGAS compatibility
-dataset = Dataset.from_pandas(df)
+## load as Dataset -> parquet stores `retrieved_contexts` as a real list column, no unwrapping needed
+if os.path.exists(RESULTS_PATH):
+    dataset = Dataset.from_parquet(RESULTS_PATH)
+else:
+    ## csv copy only -> the lists are stored as json text, parsed with json.loads (no python AST per row)
+    df = Dataset.from_csv(RESULTS_CSV_PATH).to_pandas()
+    df['retrieved_contexts'] = [json.loads(retrieved_contexts) for retrieved_contexts in df['retrieved_contexts'].values]
+    dataset = Dataset.from_pandas(df)
 
 ## evaluation
 score = evaluate(
@@ -22,7 +30,7 @@ score = evaluate(
     llm=ragas_eval_llm,
     embeddings=ragas_eval_embedF,
     metrics=[faithfulness, answer_correctness],
-    run_config=RunConfig(timeout=1200)
+    run_config=RunConfig(timeout=1200, max_workers=SCORE_MAX_WORKERS, max_wait=60, max_retries=3)
 )
 
 ## convert to pandas DataFrame
@@ -0,0 +1,51 @@
+## export all-MiniLM-L6-v2 to ONNX and apply dynamic int8 quantization
+## run once with: uv run scripts/export_quantize_minilm.py
+import os
+import torch
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from transformers import AutoModel, AutoTokenizer
+
+## setup PATH
+MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
+OUTPUT_DIR = "./data/onnx"
+FP32_MODEL_PATH = os.path.join(OUTPUT_DIR, "minilm-fp32.onnx")
+INT8_MODEL_PATH = os.path.join(OUTPUT_DIR, "minilm-int8.onnx")
+
+os.makedirs(OUTPUT_DIR, exist_ok=True)
+
+## load the model + tokenizer
+tokenizer = AutoTokenizer.from_pretrained(MODEL_NAME)
+model = AutoModel.from_pretrained(MODEL_NAME).eval()
+
+class LastHiddenState(torch.nn.Module):
+    """explicit positional signature -> the trace doesn't depend on the transformers forward() layout"""
+    def __init__(self, encoder) -> None:
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask, token_type_ids):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, token_type_ids=token_type_ids).last_hidden_state
+
+## ---- EXPORT (FP32) ----
+input_names = ["input_ids", "attention_mask", "token_type_ids"]
+sample = tokenizer(["Section 4 lays down the conditions for a special marriage."], return_tensors="pt")
+dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names + ["last_hidden_state"]}
+
+with torch.no_grad():
+    torch.onnx.export(
+        LastHiddenState(model),
+        tuple(sample[name] for name in input_names),
+        FP32_MODEL_PATH,
+        input_names=input_names,
+        output_names=["last_hidden_state"],
+        dynamic_axes=dynamic_axes,
+        opset_version=17,
+        dynamo=False ## TorchScript exporter -> honours `dynamic_axes` without needing onnxscript
+    )
+
+## ---- DYNAMIC INT8 QUANTIZATION ----
+## weights are stored as int8, activations are quantized on the fly -> VNNI int8 GEMMs on supported CPUs
+quantize_dynamic(FP32_MODEL_PATH, INT8_MODEL_PATH, weight_type=QuantType.QInt8)
+
+print(f"> FP32 model: {FP32_MODEL_PATH} ({os.path.getsize(FP32_MODEL_PATH) / 1e6:.1f} MB)")
+print(f"> INT8 model: {INT8_MODEL_PATH} ({os.path.getsize(INT8_MODEL_PATH) / 1e6:.1f} MB)")